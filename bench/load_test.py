@@ -0,0 +1,329 @@
+#!/usr/bin/python3
+
+# Load test of a whole taskmasterd: generates a config of N programs with M
+# instances each, made of local stand-ins (sleepers, crash-loopers that end
+# up FATAL, slow stoppers that ignore SIGTERM until stopwaitsecs), runs a
+# private daemon on it in a scratch directory and drives it through its
+# UNIX socket. Prints one JSON document: spawn throughput, status latency,
+# reload time, stop-all and start time, reap latency under a mass SIGKILL,
+# quit time, and the daemon's CPU time and RSS after every phase.
+#
+#   ./bench/load_test.py [programs] [instances per program]
+
+import json
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import tasksocket
+
+PROGRAMS = 100
+INSTANCES = 100
+
+STATUS_REQUESTS = 50
+
+TIMEOUT = 300.0     # seconds any single phase may take before the run is abandoned
+
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# one program in twenty crash-loops, one in twenty is slow to stop, the rest sleep
+workloads = {
+        'sleeper': {
+            'command': '/bin/sleep 100000',
+            'startsecs': '0',
+            'autorestart': 'false'
+            },
+        'crasher': {
+            'command': '/bin/sh -c "sleep 0.2; exit 3"',
+            'startsecs': '1',
+            'startretries': '2',
+            'backoff_base': '0.5',
+            'autorestart': 'true'
+            },
+        'slow': {
+            'command': '/bin/sh -c "trap \'\' TERM; exec /bin/sleep 100000"',
+            'startsecs': '0',
+            'stopwaitsecs': '1',
+            'autorestart': 'false'
+            }
+        }
+
+
+def workload(index):
+    if index % 20 == 10:
+        return 'crasher'
+    if index % 20 == 19:
+        return 'slow'
+    return 'sleeper'
+
+
+def write_config(path, programs, instances, extra=0):
+    sections = [(workload(index), index) for index in range(programs)]
+    sections += [('sleeper', index) for index in range(programs, programs + extra)]
+    with open(path, 'w') as config:
+        for kind, index in sections:
+            config.write('[program:' + kind + str(index) + ']\n')
+            config.write('numprocs=' + str(instances) + '\n')
+            config.write('stdout=NONE\nstderr=NONE\n')
+            for option, value in workloads[kind].items():
+                config.write(option + '=' + value + '\n')
+            config.write('\n')
+
+
+# The daemon runs from the scratch directory with its socket, journal and
+# log there, so the benchmark never touches a real daemon's files
+
+def launch_daemon(workdir):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.chdir(workdir)
+            sys.stdout = open(os.devnull, 'w')
+            tasksocket.SOCKFILE = os.path.join(workdir, 'taskmaster.sock')
+            import tasklog
+            tasklog.logger.path = os.path.join(workdir, 'taskmaster.log')
+            import taskmasterd
+            from taskjournal import Journal
+            taskmasterd.journal = Journal(os.path.join(workdir, 'taskmaster.journal'))
+            taskmasterd.METRICS_PORT = 0
+            taskmasterd.main()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+
+class Rpc():
+    def __init__(self, path):
+        deadline = time.monotonic() + 10
+        while True:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self.socket.connect(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                self.socket.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.01)
+        self.buffer = b''
+        self.id = 0
+    def call(self, method, **params):
+        self.id += 1
+        self.socket.sendall(json.dumps({'id': self.id, 'method': method, 'params': params}).encode() + b'\n')
+        while True:
+            message = self.read()
+            if message.get('id') == self.id:
+                if not message['ok']:
+                    raise RuntimeError(method + ': ' + str(message['error']))
+                return message['result']
+    def read(self, timeout=TIMEOUT):
+        self.socket.settimeout(timeout)
+        while b'\n' not in self.buffer:
+            data = self.socket.recv(1 << 20)
+            if not data:
+                raise ConnectionError('daemon closed the connection')
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return json.loads(line)
+    def close(self):
+        self.socket.close()
+
+
+def daemon_usage(pid):
+    with open('/proc/' + str(pid) + '/stat', 'rb') as stat:
+        data = stat.read()
+    fields = data[data.rfind(b')') + 2:].split()
+    with open('/proc/' + str(pid) + '/status') as status:
+        peak = [line for line in status if line.startswith('VmHWM:')][0].split()[1]
+    with open('/proc/' + str(pid) + '/statm') as statm:
+        rss = int(statm.read().split()[1]) * PAGE_SIZE
+    return {
+            'cpu_seconds': (int(fields[11]) + int(fields[12])) / CLK_TCK,
+            'rss_bytes': rss,
+            'peak_rss_bytes': int(peak) * 1024
+            }
+
+
+def alive(pid):
+    # the daemon is reparented to init once launched, which may take a while to reap it
+    try:
+        with open('/proc/' + str(pid) + '/stat', 'rb') as stat:
+            data = stat.read()
+    except OSError:
+        return False
+    return data[data.rfind(b')') + 2:].split()[0] != b'Z'
+
+
+def percentiles(samples, scale=1000.0, unit='ms'):
+    samples = sorted(samples)
+    if not samples:
+        return {'count': 0}
+    return {
+            'count': len(samples),
+            'p50_' + unit: round(samples[len(samples) // 2] * scale, 3),
+            'p99_' + unit: round(samples[min(len(samples) * 99 // 100, len(samples) - 1)] * scale, 3),
+            'max_' + unit: round(samples[-1] * scale, 3)
+            }
+
+
+# Crashers never reach RUNNING, so the RUNNING gauge counts the long-lived
+# instances; far cheaper for the daemon than a full status at every poll
+
+def wait_running(rpc, expected):
+    deadline = time.monotonic() + TIMEOUT
+    while True:
+        for line in rpc.call('metrics').splitlines():
+            if line.startswith('taskmaster_processes{state="RUNNING"}') and int(line.split()[1]) == expected:
+                return
+        if time.monotonic() > deadline:
+            raise TimeoutError('daemon did not settle within ' + str(TIMEOUT) + 's')
+        time.sleep(0.05)
+
+
+def status(rpc):
+    table = rpc.call('status', fields=['name', 'group', 'state', 'pid'])
+    return [dict(zip(table['columns'], row)) for row in table['rows']]
+
+
+def long_lived(info):
+    return not info['group'].startswith('crasher')
+
+
+def phase_boot(rpc, expected, begin):
+    wait_running(rpc, expected)
+    elapsed = time.monotonic() - begin
+    return {'instances': expected, 'seconds': round(elapsed, 3), 'spawns_per_second': round(expected / elapsed, 1)}
+
+
+def phase_status(rpc):
+    text = tasksocket.ClientSocket()
+    text.negotiate()
+    text_samples, rpc_samples, size = [], [], 0
+    for i in range(STATUS_REQUESTS):
+        begin = time.perf_counter()
+        text.send('status')
+        size = len(text.reply())
+        text_samples.append(time.perf_counter() - begin)
+        begin = time.perf_counter()
+        rpc.call('status')
+        rpc_samples.append(time.perf_counter() - begin)
+    text.send('exit')
+    text.close()
+    return {'text': percentiles(text_samples), 'rpc': percentiles(rpc_samples), 'text_reply_bytes': size}
+
+
+def phase_reload(rpc, config, programs, instances, expected):
+    begin = time.perf_counter()
+    rpc.call('reload')
+    unchanged = time.perf_counter() - begin
+    write_config(config, programs, instances, extra=1)
+    begin = time.perf_counter()
+    rpc.call('reload')
+    added = time.perf_counter() - begin
+    wait_running(rpc, expected + instances)
+    return {'unchanged_ms': round(unchanged * 1000, 3), 'one_program_added_ms': round(added * 1000, 3),
+            'instances_added': instances}
+
+
+def phase_stop_all(rpc):
+    begin = time.perf_counter()
+    results = rpc.call('stop', names=['all'])
+    return {'instances': len(results), 'seconds': round(time.perf_counter() - begin, 3),
+            'stopped': sum(1 for result in results if result['result'] == 'stopped')}
+
+
+def phase_start(rpc, infos):
+    groups = sorted(set(info['group'] + ':*' for info in infos if long_lived(info)))
+    begin = time.perf_counter()
+    results = rpc.call('start', names=groups)
+    elapsed = time.perf_counter() - begin
+    return {'instances': len(results), 'seconds': round(elapsed, 3), 'spawns_per_second': round(len(results) / elapsed, 1),
+            'started': sum(1 for result in results if result['result'] == 'started')}
+
+
+def phase_mass_exit(rpc, events):
+    infos = status(rpc)
+    victims = dict((info['name'], info['pid']) for info in infos
+            if info['group'].startswith('sleeper') and info['state'] == 'RUNNING')
+    events.call('subscribe', names=sorted(set(info['group'] + ':*' for info in infos if info['name'] in victims)))
+    begin = time.time()
+    for pid in victims.values():
+        os.kill(pid, signal.SIGKILL)
+    samples, dropped = [], 0
+    while len(samples) + dropped < len(victims):   # a dropped event is one exit we can't time
+        event = events.read().get('event')
+        if event is None:
+            continue
+        if event.get('type') == 'dropped':
+            dropped += event['count']
+        elif event['to'] == 'EXITED' and event['name'] in victims:
+            samples.append(event['time'] - begin)
+    events.call('unsubscribe')
+    reaped = percentiles(samples)
+    reaped['killed'] = len(victims)
+    reaped['events_dropped'] = dropped
+    return reaped
+
+
+def phase_quit(rpc, daemon):
+    begin = time.perf_counter()
+    text = tasksocket.ClientSocket()
+    text.negotiate()
+    text.send('quit')
+    text.reply()
+    text.close()
+    while alive(daemon):
+        time.sleep(0.01)
+    return {'seconds': round(time.perf_counter() - begin, 3)}
+
+
+def main():
+    programs = int(sys.argv[1]) if len(sys.argv) > 1 else PROGRAMS
+    instances = int(sys.argv[2]) if len(sys.argv) > 2 else INSTANCES
+    workdir = tempfile.mkdtemp(prefix='taskmaster-bench-')
+    config = os.path.join(workdir, 'taskmaster.conf')
+    tasksocket.SOCKFILE = os.path.join(workdir, 'taskmaster.sock')
+    write_config(config, programs, instances)
+    expected = sum(instances for index in range(programs) if workload(index) != 'crasher')
+    results = {'programs': programs, 'instances_per_program': instances, 'instances': programs * instances,
+            'phases': dict()}
+    phases = results['phases']
+    daemon = None
+    try:
+        begin = time.monotonic()
+        launch_daemon(workdir)
+        rpc = Rpc(tasksocket.SOCKFILE)
+        events = Rpc(tasksocket.SOCKFILE)
+        daemon = rpc.call('pid')
+        def record(name, result):
+            result['daemon'] = daemon_usage(daemon)
+            phases[name] = result
+        record('boot', phase_boot(rpc, expected, begin))
+        record('status', phase_status(rpc))
+        record('reload', phase_reload(rpc, config, programs, instances, expected))
+        infos = status(rpc)
+        record('stop_all', phase_stop_all(rpc))
+        record('start', phase_start(rpc, infos))
+        record('mass_exit', phase_mass_exit(rpc, events))
+        results['daemon_peak_rss_bytes'] = daemon_usage(daemon)['peak_rss_bytes']
+        phases['quit'] = phase_quit(rpc, daemon)
+        daemon = None
+    finally:
+        if daemon:
+            try:
+                os.killpg(daemon, signal.SIGKILL)   # the daemon's session holds all its children
+            except ProcessLookupError:
+                pass
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
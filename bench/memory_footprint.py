@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+
+# Memory footprint of the daemon's process table: RSS growth and traced
+# bytes per Process instance for a single program scaled through numprocs.
+# Each size is measured in a fresh child so the runs don't share a heap.
+#
+#   ./bench/memory_footprint.py [count...]
+
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import taskmasterd
+
+SIZES = [1000, 10000, 50000]
+
+
+def rss():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure(count):
+    options = {'command': '/bin/true', 'numprocs': str(count), 'environment': 'FOO:"bar",BAR:"baz"'}
+    rss_before = rss()
+    tracemalloc.start()
+    spec = taskmasterd.ProgramSpec('bench', options)
+    processes = taskmasterd.create_processes({'bench': spec})
+    traced, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_after = rss()
+    return {
+            'instances': len(processes),
+            'rss_bytes': rss_after,
+            'rss_growth_bytes': rss_after - rss_before,
+            'traced_bytes': traced,
+            'peak_traced_bytes': peak,
+            'bytes_per_instance': round(traced / len(processes), 1)
+            }
+
+
+def measure_in_child(count):
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        os.write(w, json.dumps(measure(count)).encode())
+        os._exit(0)
+    os.close(w)
+    data = b''
+    while True:
+        chunk = os.read(r, 65536)
+        if not chunk:
+            break
+        data += chunk
+    os.close(r)
+    os.waitpid(pid, 0)
+    return json.loads(data)
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    print(json.dumps([measure_in_child(count) for count in sizes], indent=4))
+
+
+if __name__ == '__main__':
+    main()
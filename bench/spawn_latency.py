@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+
+# Spawn latency of the fork+exec path against the posix_spawn path of
+# taskmasterd.Process, with an optionally inflated daemon heap (fork has
+# to copy the page tables of the whole address space, posix_spawn doesn't).
+#
+#   ./bench/spawn_latency.py [count] [heap MB]
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import taskmasterd
+
+
+def measure(spawn, count, *args):
+    samples = []
+    for i in range(count):
+        begin = time.perf_counter()
+        pid = spawn({}, *args)
+        samples.append(time.perf_counter() - begin)
+        os.waitpid(pid, 0)
+    samples.sort()
+    return {
+            'count': count,
+            'mean_us': round(sum(samples) / count * 1e6, 1),
+            'p50_us': round(samples[count // 2] * 1e6, 1),
+            'p99_us': round(samples[min(count - 1, int(count * 0.99))] * 1e6, 1)
+            }
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    heap_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    ballast = bytearray(heap_mb * 1024 * 1024)
+    for i in range(0, len(ballast), 4096):
+        ballast[i] = 1   # touch every page so it is really mapped
+    spec = taskmasterd.ProgramSpec('bench', {'command': '/bin/true', 'directory': os.getcwd(),
+            'stdout': '/dev/null', 'stderr': '/dev/null'})
+    proc = taskmasterd.Process('bench', spec)
+    results = {'heap_mb': heap_mb, 'fork_exec': measure(proc._fork_exec, count, [])}   # no listening sockets
+    if hasattr(os, 'posix_spawn'):
+        results['posix_spawn'] = measure(proc._posix_spawn, count)
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
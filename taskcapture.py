@@ -0,0 +1,125 @@
+import os
+
+READ_SIZE = 65536
+
+MAX_LINE = 65536    # a line longer than this is written out without waiting for its newline
+
+TAIL_SIZE = 64 * 1024   # recent output kept in memory per process
+
+logfiles = dict()   # path -> RotatingFile, shared by every pipe writing to the same path
+
+
+class RotatingFile():
+    def __init__(self, path, maxbytes, backups):
+        self.path = path
+        self.maxbytes = maxbytes
+        self.backups = backups
+        self.fd = -1
+        self.size = 0
+    def _open(self):
+        if self.fd < 0:
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self.size = os.fstat(self.fd).st_size
+    def write(self, data):
+        try:
+            self._open()
+            os.write(self.fd, data)
+        except OSError:
+            return
+        self.size += len(data)
+        if self.maxbytes and self.size >= self.maxbytes:
+            self.rotate()
+    def rotate(self):
+        self.close()
+        try:
+            if self.backups > 0:
+                for i in range(self.backups - 1, 0, -1):
+                    src = self.path + '.' + str(i)
+                    if os.path.exists(src):
+                        os.replace(src, self.path + '.' + str(i + 1))
+                os.replace(self.path, self.path + '.1')
+            else:
+                os.truncate(self.path, 0)
+        except OSError:
+            pass
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+            self.size = 0
+
+
+def open_logfile(path, maxbytes, backups):
+    logfile = logfiles.get(path)
+    if logfile is None:
+        logfile = logfiles[path] = RotatingFile(path, maxbytes, backups)
+    else:
+        logfile.maxbytes, logfile.backups = maxbytes, backups
+    return logfile
+
+
+class TailBuffer():
+    def __init__(self, size=TAIL_SIZE):
+        self.size = size
+        self.data = bytearray()
+        self.followers = list()
+    def append(self, data):
+        self.data += data
+        if len(self.data) > self.size:
+            del self.data[:len(self.data) - self.size]
+        for follower in list(self.followers):
+            follower(data)
+    def get(self, size=None):
+        if size is None or size >= len(self.data):
+            return bytes(self.data)
+        return bytes(self.data[len(self.data) - size:])
+    def follow(self, callback):
+        self.followers.append(callback)
+    def unfollow(self, callback):
+        if callback in self.followers:
+            self.followers.remove(callback)
+
+
+class OutputPipe():
+    def __init__(self, loop, fd, logfile, listener=None):
+        self.loop = loop
+        self.fd = fd
+        self.logfile = logfile
+        self.listener = listener
+        self.partial = bytearray()
+        os.set_blocking(fd, False)
+        self.loop.add_reader(fd, self.read)
+    def read(self):
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.close()
+            return
+        if self.listener:
+            self.listener(data)
+        end = data.rfind(b'\n')
+        if end < 0:
+            self.partial += data
+            if len(self.partial) >= MAX_LINE:
+                self.logfile.write(self.partial)
+                self.partial.clear()
+            return
+        if self.partial:
+            self.logfile.write(bytes(self.partial) + data[:end + 1])
+            self.partial.clear()
+        else:
+            self.logfile.write(data[:end + 1])
+        self.partial += data[end + 1:]
+    def close(self):
+        if self.fd < 0:
+            return
+        if self.partial:
+            self.logfile.write(bytes(self.partial) + b'\n')
+            self.partial.clear()
+        self.loop.remove_reader(self.fd)
+        os.close(self.fd)
+        self.fd = -1
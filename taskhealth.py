@@ -0,0 +1,148 @@
+import collections
+import errno
+import os
+import shlex
+import signal
+import socket
+import time
+
+PROBE_CONCURRENCY = 16  # probes in flight at once, across every program and instance
+
+probe_kinds = ('tcp', 'unix', 'exec', 'file')
+
+
+# healthcheck = tcp:<host>:<port> | unix:<path> | exec:<command> | file:<path>
+# {name} and {index} in the target are replaced per instance
+
+def parse_healthcheck(value):
+    kind, _, target = value.partition(':')
+    if kind not in probe_kinds or not target:
+        raise ValueError(value)
+    probe_target(kind, target.replace('{name}', 'program').replace('{index}', '0'))
+    return (kind, target)
+
+
+def probe_target(kind, target):
+    if kind == 'tcp':
+        host, _, port = target.rpartition(':')
+        port = int(port)
+        if not host or not 0 < port < 65536:
+            raise ValueError(target)
+        if host.startswith('['):
+            return (socket.AF_INET6, (host.strip('[]'), port))
+        return (socket.AF_INET, (host, port))
+    elif kind == 'unix':
+        return (socket.AF_UNIX, target)
+    elif kind == 'exec':
+        argv = shlex.split(target)
+        if not argv:
+            raise ValueError(target)
+        return argv
+    return target
+
+
+# Probe scheduler: every probe of every instance goes through one bounded
+# queue, sockets are connected non-blocking on the daemon's event loop and
+# exec probes are reaped with the daemon's other children
+
+class ProbeScheduler():
+    def __init__(self, loop, concurrency=PROBE_CONCURRENCY):
+        self.loop = loop
+        self.concurrency = concurrency
+        self.queue = collections.deque()
+        self.running = 0
+        self.children = dict()   # pid -> Probe of a running exec probe
+    def submit(self, kind, target, timeout, stale, callback, *args):
+        self.queue.append(Probe(self, kind, target, timeout, stale, callback, args))
+        self.pump()
+    def pump(self):
+        while self.queue and self.running < self.concurrency:
+            self.running += 1
+            self.queue.popleft().run()
+    def child_exited(self, pid, status):
+        probe = self.children.pop(pid, None)
+        if probe is None:
+            return False
+        probe.pid = 0
+        if status is None:
+            probe.finish(False, 'exit status lost')
+        elif os.WIFSIGNALED(status):
+            probe.finish(False, 'killed by signal ' + str(os.WTERMSIG(status)))
+        else:
+            probe.finish(os.WEXITSTATUS(status) == 0, 'exit ' + str(os.WEXITSTATUS(status)))
+        return True
+
+
+class Probe():
+    __slots__ = ('scheduler', 'kind', 'target', 'timeout', 'stale', 'callback', 'args', 'socket', 'pid', 'timer', 'done')
+    def __init__(self, scheduler, kind, target, timeout, stale, callback, args):
+        self.scheduler = scheduler
+        self.kind = kind
+        self.target = target
+        self.timeout = timeout
+        self.stale = stale      # file heartbeats older than this many seconds fail
+        self.callback = callback
+        self.args = args
+        self.socket = None
+        self.pid = 0
+        self.timer = None
+        self.done = False
+    def run(self):
+        try:
+            if self.kind in ('tcp', 'unix'):
+                self.connect()
+            elif self.kind == 'exec':
+                self.spawn()
+            else:
+                age = time.time() - os.stat(self.target).st_mtime
+                self.finish(age <= self.stale, 'heartbeat ' + str(int(age)) + 's old')
+                return
+        except (OSError, ValueError) as err:
+            self.finish(False, getattr(err, 'strerror', None) or str(err))
+            return
+        if not self.done:
+            self.timer = self.scheduler.loop.call_later(self.timeout, self.expire)
+    def connect(self):
+        family, address = probe_target(self.kind, self.target)
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.setblocking(False)
+        err = self.socket.connect_ex(address)
+        if err == 0:
+            self.finish(True, '')
+        elif err in (errno.EINPROGRESS, errno.EAGAIN):
+            self.scheduler.loop.add_writer(self.socket, self.connected)
+        else:
+            self.finish(False, os.strerror(err))
+    def connected(self):
+        err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        self.finish(not err, os.strerror(err) if err else '')
+    def spawn(self):
+        argv = probe_target(self.kind, self.target)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        try:
+            self.pid = os.posix_spawn(argv[0], argv, os.environ, setpgroup=0, setsigdef=(signal.SIGPIPE, signal.SIGXFSZ),
+                    file_actions=[(os.POSIX_SPAWN_DUP2, devnull, 0), (os.POSIX_SPAWN_DUP2, devnull, 1),
+                    (os.POSIX_SPAWN_DUP2, devnull, 2)])
+        finally:
+            os.close(devnull)
+        self.scheduler.children[self.pid] = self
+    def expire(self):
+        self.timer = None
+        self.finish(False, 'timed out after ' + '%g' % self.timeout + 's')
+    def finish(self, ok, detail):
+        if self.done:
+            return
+        self.done = True
+        if self.timer:
+            self.timer.cancel()
+        if self.socket:
+            self.scheduler.loop.remove_writer(self.socket)
+            self.socket.close()
+        if self.pid:
+            try:
+                os.killpg(self.pid, signal.SIGKILL)   # with whatever it forked; reaped later, its status is ignored
+            except ProcessLookupError:
+                pass
+        self.scheduler.running -= 1
+        self.callback(ok, detail, *self.args)
+        self.scheduler.pump()
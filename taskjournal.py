@@ -0,0 +1,106 @@
+import ctypes
+import json
+import os
+import stat
+
+JOURNAL = '/tmp/taskmaster.journal'
+
+COMPACT_AFTER = 4096    # records appended before the journal is rewritten as a snapshot
+
+PR_SET_CHILD_SUBREAPER = 36
+
+
+# Append-only state journal: one JSON object per line, the last line for a
+# name wins. A torn last line (daemon killed mid-write) is skipped on load.
+
+class Journal():
+    def __init__(self, path=JOURNAL):
+        self.path = path
+        self.fd = -1
+        self.appended = 0
+    def load(self):
+        records = dict()
+        try:
+            fd = os.open(self.path, os.O_RDONLY | os.O_NOFOLLOW)
+        except OSError:
+            return records
+        with open(fd, 'rb') as journal:
+            if not trusted(fd):
+                return records   # its records decide which pids get signalled
+            try:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if isinstance(record, dict) and 'name' in record:
+                        records[record['name']] = record
+            except OSError:
+                pass
+        return records
+    def append(self, record):
+        try:
+            if self.fd < 0:
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+                if not trusted(fd):
+                    os.close(fd)
+                    return False
+                self.fd = fd
+            os.write(self.fd, encode(record))
+        except OSError:
+            return False
+        self.appended += 1
+        return self.appended >= COMPACT_AFTER
+    def compact(self, records):
+        tmp = self.path + '.tmp'
+        try:
+            try:
+                os.unlink(tmp)   # a leftover, or someone else's file: then this fails and so does compaction
+            except FileNotFoundError:
+                pass
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+            try:
+                os.write(fd, b''.join(encode(record) for record in records))
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.replace(tmp, self.path)
+        except OSError:
+            return
+        self.close()
+        self.appended = 0
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+# The journal lives in a shared directory: only a file of our own that
+# nobody else can write is believed
+
+def trusted(fd):
+    info = os.fstat(fd)
+    return stat.S_ISREG(info.st_mode) and info.st_uid == os.geteuid() and not info.st_mode & 0o022
+
+
+def encode(record):
+    return json.dumps(record, separators=(',', ':')).encode() + b'\n'
+
+
+def set_subreaper():
+    # orphaned descendants of supervised programs are reparented to the daemon instead of init
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) == 0
+    except (OSError, AttributeError):
+        return False
+
+
+def watch_pid(pid):
+    # a pidfd becomes readable once the process exits, whoever its parent is
+    if not hasattr(os, 'pidfd_open'):
+        return None
+    try:
+        return os.pidfd_open(pid)
+    except OSError:
+        return None
@@ -0,0 +1,122 @@
+import ctypes
+import errno
+import os
+import platform
+import resource
+
+CGROUP_ROOT = '/sys/fs/cgroup'    # relative cgroup paths are created under this mount
+
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+
+rlimit_options = {
+        'rlimit_nofile': resource.RLIMIT_NOFILE,
+        'rlimit_as': resource.RLIMIT_AS,
+        'rlimit_core': resource.RLIMIT_CORE
+        }
+
+cgroup_options = {
+        'memory_max': 'memory.max',
+        'cpu_max': 'cpu.max'
+        }
+
+ionice_classes = {
+        'realtime': 1,
+        'best-effort': 2,
+        'idle': 3
+        }
+
+ioprio_set_syscalls = {
+        'x86_64': 251,
+        'i386': 289,
+        'i686': 289,
+        'aarch64': 30,
+        'riscv64': 30,
+        'armv7l': 314,
+        'ppc64le': 273,
+        's390x': 282
+        }
+
+
+# Option parsers: raise ValueError on anything the config checker should reject
+
+def parse_rlimit(value):
+    if value == 'unlimited':
+        return resource.RLIM_INFINITY
+    limit = int(value)
+    if limit < 0:
+        raise ValueError(value)
+    return limit
+
+
+def parse_nice(value):
+    nice = int(value)
+    if not -20 <= nice <= 19:
+        raise ValueError(value)
+    return nice
+
+
+def parse_ionice(value):
+    name, _, level = value.partition(':')
+    if name not in ionice_classes:
+        raise ValueError(value)
+    level = int(level) if level else 4
+    if not 0 <= level <= 7:
+        raise ValueError(value)
+    return (ionice_classes[name], level)
+
+
+def parse_cpus(value):
+    cpus = set()
+    for part in value.split(','):
+        if not part.strip():
+            continue
+        first, _, last = part.strip().partition('-')
+        first = int(first)
+        last = int(last) if last else first
+        if first < 0 or last < first:
+            raise ValueError(value)
+        cpus.update(range(first, last + 1))
+    if not cpus:
+        raise ValueError(value)
+    return tuple(sorted(cpus))
+
+
+def cgroup_path(value):
+    return os.path.join(CGROUP_ROOT, value)
+
+
+# Applied in the forked child, between redirection and exec
+
+def apply_limits(spec, index):
+    if spec.cgroup:
+        join_cgroup(spec.cgroup, spec.cgroup_limits)
+    for limit, value in spec.rlimits:
+        resource.setrlimit(limit, (value, value))
+    if spec.nice is not None:
+        os.setpriority(os.PRIO_PROCESS, 0, spec.nice)
+    if spec.ionice:
+        set_ionice(*spec.ionice)
+    if spec.cpus:
+        os.sched_setaffinity(0, [spec.cpus[index % len(spec.cpus)]] if spec.cpu_pin else spec.cpus)
+
+
+def join_cgroup(path, limits):
+    os.makedirs(path, exist_ok=True)
+    if not os.path.exists(os.path.join(path, 'cgroup.controllers')):
+        raise OSError(errno.ENOTSUP, path + ' is not in a cgroup v2 hierarchy')
+    for name, value in limits:
+        with open(os.path.join(path, name), 'w') as control:
+            control.write(value)
+    with open(os.path.join(path, 'cgroup.procs'), 'w') as procs:
+        procs.write(str(os.getpid()))
+
+
+def set_ionice(ioclass, level):
+    nr = ioprio_set_syscalls.get(platform.machine())
+    if nr is None:
+        raise OSError(errno.ENOSYS, 'ioprio_set not supported on ' + platform.machine())
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(nr, IOPRIO_WHO_PROCESS, 0, (ioclass << IOPRIO_CLASS_SHIFT) | level) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, 'ioprio_set: ' + os.strerror(err))
@@ -0,0 +1,71 @@
+import fcntl
+import os
+import socket
+
+from taskhealth import probe_target
+
+LISTEN_FDS_START = 3    # first passed fd, as with systemd socket activation
+
+LISTEN_BACKLOG = 128
+
+
+# listen = tcp:<host>:<port>[,unix:<path>...]
+
+def parse_listen(value):
+    addresses = tuple(address.strip() for address in value.split(',') if address.strip())
+    for address in addresses:
+        kind, _, target = address.partition(':')
+        if kind not in ('tcp', 'unix') or not target:
+            raise ValueError(address)
+        probe_target(kind, target)
+    if not addresses:
+        raise ValueError(value)
+    return addresses
+
+
+def bind_listener(address):
+    kind, _, target = address.partition(':')
+    family, bind_address = probe_target(kind, target)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        if kind == 'tcp':
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                # children adopted from a previous daemon may still be listening on it
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        else:
+            try:
+                os.unlink(target)
+            except FileNotFoundError:
+                pass
+        sock.bind(bind_address)
+        sock.listen(LISTEN_BACKLOG)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def close_listener(address, sock):
+    sock.close()
+    kind, _, target = address.partition(':')
+    if kind == 'unix':
+        try:
+            os.unlink(target)
+        except OSError:
+            pass
+
+
+# In the forked child: the sockets become fds 3.. and the environment says
+# how many, so programs written for systemd socket activation work unchanged
+
+def pass_listeners(sockets, env):
+    high = LISTEN_FDS_START + len(sockets)
+    fds = [fcntl.fcntl(sock.fileno(), fcntl.F_DUPFD, high) for sock in sockets]
+    for index, fd in enumerate(fds):
+        os.dup2(fd, LISTEN_FDS_START + index)
+        os.close(fd)
+    env = dict(env)
+    env['LISTEN_FDS'] = str(len(sockets))
+    env['LISTEN_PID'] = str(os.getpid())
+    return env
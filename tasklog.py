@@ -1,11 +1,21 @@
+import collections
 import errno
 import os
+import threading
 import time
 
 LOGFILE = '/tmp/taskmaster.log'
+
+LOG_BUFFER = 4096       # events kept in memory while the writer catches up, oldest dropped first
+FLUSH_LINES = 64        # wake the writer as soon as this many events are pending
+FLUSH_INTERVAL = 0.5    # otherwise flush at least this often (seconds)
+FSYNC = 'never'         # 'never', 'interval' (every FSYNC_INTERVAL seconds) or 'always' (every batch)
+FSYNC_INTERVAL = 5.0
+
 logs = {
         'DAEMON': ('INFO', 'daemon started with pid:'),
         'SPAWN': ('INFO', 'process spawned with pid:'),
+        'SPAWNERR': ('WARN', 'process could not be spawned:'),
         'BACKOFF': ('INFO', 'process backingoff, exit code:'),
         'EXIT': ('INFO', 'process exited, exit code:'),
         'WAITSTOP': ('INFO', 'waiting for process to stop with signal:'),
@@ -17,12 +27,117 @@ logs = {
         'CONFIG': ('ERROR', 'couldn\'t open configuration file'),
         'SECTION': ('ERROR', 'section naming format not allowed in your configuration file !'),
         'OPTION': ('ERROR', 'option Key or Value not allowed in your configuration file !'),
+        'DEPENDS': ('ERROR', 'depends_on names an unknown program or forms a cycle in your configuration file !'),
+        'METRICS': ('WARN', 'couldn\'t bind the metrics endpoint on port'),
+        'ACCEPT': ('WARN', 'couldn\'t accept a connection:'),
+        'ADOPT': ('INFO', 'process adopted from the state journal with pid:'),
+        'ORPHAN': ('WARN', 'process no longer configured, sent SIGTERM to pid:'),
+        'READY': ('INFO', 'process passed its first healthcheck, running with pid:'),
+        'UNREADY': ('WARN', 'process killed, no healthcheck passed within ready_timeout:'),
+        'UNHEALTHY': ('WARN', 'process failing its healthcheck, restarting:'),
+        'SCALE': ('INFO', 'program autoscaled:'),
+        'CALLBACK': ('ERROR', 'event loop callback raised, carrying on:'),
         'QUIT': ('INFO','quitting daemon process')
         }
 
+
+class Logger():
+    def __init__(self, path):
+        self.path = path
+        self.logfile = None
+        self.buffer = collections.deque(maxlen=LOG_BUFFER)
+        self.dropped = 0
+        self.cond = threading.Condition()
+        self.writer = None
+        self.running = False
+        self.last_fsync = time.monotonic()
+
+    def _open(self):
+        if self.logfile is None:
+            self.logfile = open(self.path, 'a')
+        return self.logfile
+
+    def log(self, line):
+        with self.cond:
+            if not self.running:
+                self._write([line])
+                return
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1
+            self.buffer.append(line)
+            if len(self.buffer) >= FLUSH_LINES:
+                self.cond.notify()
+
+    def _write(self, lines):
+        try:
+            logfile = self._open()
+            logfile.write(''.join(lines))
+            logfile.flush()
+            now = time.monotonic()
+            if FSYNC == 'always' or (FSYNC == 'interval' and now - self.last_fsync >= FSYNC_INTERVAL):
+                os.fsync(logfile.fileno())
+                self.last_fsync = now
+        except OSError:
+            pass
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if self.running and len(self.buffer) < FLUSH_LINES:
+                    self.cond.wait(FLUSH_INTERVAL)
+                lines = list(self.buffer)
+                self.buffer.clear()
+                dropped, self.dropped = self.dropped, 0
+                running = self.running
+            if dropped:
+                lines.insert(0, format_line('WARN', 'tasklog', str(dropped) + ' events dropped, writer fell behind'))
+            if lines:
+                self._write(lines)
+            if not running:
+                return
+
+    def start(self):
+        with self.cond:
+            if self.running:
+                return
+            self.running = True
+        self.writer = threading.Thread(target=self._run, name='tasklog', daemon=True)
+        self.writer.start()
+
+    def stop(self):
+        with self.cond:
+            if not self.running:
+                return
+            self.running = False
+            self.cond.notify()
+        self.writer.join()
+        self.writer = None
+
+    def after_fork(self):
+        # the writer thread does not survive fork: the child writes synchronously
+        self.cond = threading.Condition()
+        self.buffer.clear()
+        self.logfile = None
+        self.writer = None
+        self.running = False
+
+
+logger = Logger(LOGFILE)
+
+os.register_at_fork(after_in_child=logger.after_fork)
+
+
+def format_line(level, proc, msg):
+    return time.asctime() + ' ' + level + ' ' + proc + ' : ' + msg + '\n'
+
+
 def tasklog(log, proc, info):
-    if os.path.exists(LOGFILE):
-        logfile = open(LOGFILE, 'a')
-    else:
-        logfile = open(LOGFILE, 'w')
-    logfile.write(time.asctime() + ' ' + logs[log][0] + ' ' + proc + ' : ' + logs[log][1] + ' ' + info +'\n')
+    logger.log(format_line(logs[log][0], proc, logs[log][1] + ' ' + info))
+
+
+def start_logger():
+    logger.start()
+
+
+def stop_logger():
+    logger.stop()
@@ -0,0 +1,139 @@
+import heapq
+import itertools
+import os
+import selectors
+import signal
+import sys
+import time
+import traceback
+
+
+class Timer():
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+    def cancel(self):
+        self.cancelled = True
+
+
+class EventLoop():
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.timers = []
+        self.sequence = itertools.count()
+        self.signal_handlers = dict()
+        self.running = False
+        self.error_handler = _print_error
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, ((self._read_signals, ()), None))
+        signal.set_wakeup_fd(self.wakeup_w, warn_on_full_buffer=False)
+
+    # Signals: the C level handler writes the signal number to the self-pipe,
+    # the Python handler does nothing, the loop dispatches once per batch.
+
+    def add_signal(self, sig, callback):
+        self.signal_handlers[sig] = callback
+        signal.signal(sig, _enqueue_signal)
+
+    def _read_signals(self):
+        received = set()
+        while True:
+            try:
+                data = os.read(self.wakeup_r, 4096)
+            except (BlockingIOError, InterruptedError):
+                break
+            if not data:
+                break
+            received.update(data)
+        for sig in received:
+            if sig in self.signal_handlers:
+                self._call(self.signal_handlers[sig], ())
+
+    # File descriptors
+
+    def _update(self, fileobj, reader, writer):
+        try:
+            self.selector.unregister(fileobj)
+        except (KeyError, ValueError):
+            pass
+        events = (selectors.EVENT_READ if reader else 0) | (selectors.EVENT_WRITE if writer else 0)
+        if events:
+            self.selector.register(fileobj, events, (reader, writer))
+
+    def _handlers(self, fileobj):
+        try:
+            return self.selector.get_key(fileobj).data
+        except (KeyError, ValueError):
+            return (None, None)
+
+    def add_reader(self, fileobj, callback, *args):
+        self._update(fileobj, (callback, args), self._handlers(fileobj)[1])
+
+    def remove_reader(self, fileobj):
+        self._update(fileobj, None, self._handlers(fileobj)[1])
+
+    def add_writer(self, fileobj, callback, *args):
+        self._update(fileobj, self._handlers(fileobj)[0], (callback, args))
+
+    def remove_writer(self, fileobj):
+        self._update(fileobj, self._handlers(fileobj)[0], None)
+
+    # Timers
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(time.monotonic() + delay, callback, args)
+        heapq.heappush(self.timers, (timer.when, next(self.sequence), timer))
+        return timer
+
+    def call_soon(self, callback, *args):
+        return self.call_later(0, callback, *args)
+
+    def _run_timers(self):
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            timer = heapq.heappop(self.timers)[2]
+            if not timer.cancelled:
+                self._call(timer.callback, timer.args)
+
+    def _timeout(self):
+        while self.timers and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)
+        if not self.timers:
+            return None
+        return max(self.timers[0][0] - time.monotonic(), 0)
+
+    # Main loop
+
+    def run(self):
+        self.running = True
+        while self.running:
+            for key, mask in self.selector.select(self._timeout()):
+                reader, writer = key.data
+                if mask & selectors.EVENT_READ and reader:
+                    self._call(*reader)
+                if mask & selectors.EVENT_WRITE and writer and self._handlers(key.fileobj)[1] is writer:
+                    self._call(*writer)
+            self._run_timers()
+
+    # One failing callback must not take the whole loop, and the daemon, down
+
+    def _call(self, callback, args):
+        try:
+            callback(*args)
+        except Exception as err:
+            self.error_handler(callback, err)
+
+    def stop(self):
+        self.running = False
+
+
+def _enqueue_signal(sig, frame):
+    pass
+
+
+def _print_error(callback, err):
+    traceback.print_exception(type(err), err, err.__traceback__, file=sys.stderr)
@@ -12,17 +12,24 @@ from tasksocket import *
 
 
 client = ClientSocket()
+client.negotiate()
+
+following = None   # command that ends the stream being followed ('untail', 'unsubscribe')
 
 
 builtins = [
         'start',
         'restart',
+        'rolling-restart',
         'stop',
         'reload',
         'quit',
         'exit',
         'help',
-        'pid'
+        'pid',
+        'tail',
+        'subscribe',
+        'metrics'
         ]
 
 def completion(text, state):
@@ -37,7 +44,7 @@ readline.parse_and_bind("bind ^I rl_complete")
 def read_line():
     while True:
         line = list(input("taskmaster> ").split(' '))
-        if len(line) > 2 or len(line) == 0:
+        if len(line) == 0:
             continue
         if line[0] == 'status':
             status_cmd(line)
@@ -45,6 +52,8 @@ def read_line():
             start_cmd(line)
         elif line[0] == 'restart':
             restart_cmd(line)
+        elif line[0] == 'rolling-restart':
+            rolling_restart_cmd(line)
         elif line[0] == 'stop':
             stop_cmd(line)
         elif line[0] == 'reload':
@@ -53,6 +62,12 @@ def read_line():
             quit_cmd(line)
         elif line[0] == 'pid':
             pid_cmd(line)
+        elif line[0] == 'tail':
+            tail_cmd(line)
+        elif line[0] == 'subscribe':
+            subscribe_cmd(line)
+        elif line[0] == 'metrics':
+            metrics_cmd(line)
         elif line[0] == 'help':
             help_cmd()
         elif line[0] == 'exit':
@@ -61,42 +76,48 @@ def read_line():
             print('No such command: type "help"')
 
 def recv():
-    while True:
-        data = client.recv()
-        if not data or data == END:
-            break
+    data = client.reply()
+    if data:
         print(data)
 
 def status_cmd(line):
-    if len(line) == 1:
+    if len(line) == 1 or (len(line) == 2 and line[1] == '-v'):
         client.send(' '.join(line))
         recv()
     else:
-        print('Status has no second agrument')
+        print('status: [-v]')
         return 
 
 def start_cmd(line):
-    if len(line) == 2:
+    if len(line) >= 2:
         client.send(' '.join(line))
         recv()
     else:
-        print('start: <program name>')
+        print('start: <program name>... | <name>:* | all')
         return
 
 def restart_cmd(line):
-    if len(line) == 2:
+    if len(line) >= 2:
         client.send(' '.join(line))
         recv()
     else:
-        print('restart: <program name>')
+        print('restart: <program name>... | <name>:* | all')
+        return
+
+def rolling_restart_cmd(line):
+    if len(line) >= 2:
+        client.send(' '.join(line))
+        recv()
+    else:
+        print('rolling-restart: [-b <count>] <program name>... | <name>:* | all')
         return
 
 def stop_cmd(line):
-    if len(line) == 2:
+    if len(line) >= 2:
         client.send(' '.join(line))
         recv()
     else:
-        print('stop: <program name>')
+        print('stop: <program name>... | <name>:* | all')
         return
 
 def reload_cmd(line):
@@ -125,12 +146,57 @@ def pid_cmd(line):
         print('Pid has no second argument')
         return
 
+def metrics_cmd(line):
+    if len(line) == 1:
+        client.send(' '.join(line))
+        recv()
+    else:
+        print('Metrics has no second argument')
+        return
+
+def tail_cmd(line):
+    if len(line) == 2:
+        client.send(' '.join(line))
+        recv()
+    elif len(line) == 3 and line[1] == '-f':
+        client.send(' '.join(line))
+        data = client.reply()
+        print(data)
+        if data.startswith('Following'):
+            follow('untail', '')
+    else:
+        print('tail: [-f] <program name>')
+
+def subscribe_cmd(line):
+    client.send(' '.join(line))
+    data = client.reply()
+    print(data)
+    if data.startswith('Subscribed'):
+        follow('unsubscribe', '\n')
+
+def follow(stop, separator):
+    global following
+    following = stop
+    while True:
+        data = client.recv()
+        if data is None or data == END:
+            break
+        sys.stdout.write(data + separator)
+        sys.stdout.flush()
+    following = None
+
 def help_cmd():
     print("Default commands:")
     print("=================")
     print("status   start    restart")
     print("stop     reload   exit(shell)") 
-    print("pid      quit(everything)") 
+    print("pid      tail     subscribe") 
+    print("metrics  rolling-restart") 
+    print("quit(everything)") 
+    print("tail -f <program name> follows the output until Ctrl-C") 
+    print("status -v adds pid, cpu, rss, open fds and uptime") 
+    print("subscribe [<program name>...] streams state changes until Ctrl-C") 
+    print("rolling-restart [-b <count>] restarts <count> instances at a time, each batch once the previous one is running") 
 
 
 def exit_cmd():
@@ -139,6 +205,9 @@ def exit_cmd():
     sys.exit()
 
 def sig_handler(sig, frame):
+    if following and sig == signal.SIGINT:
+        client.send(following)
+        return
     exit_cmd()
 
 
@@ -7,15 +7,29 @@ import time
 import signal
 import socket
 import struct
-import copy
 import sys
 import errno
+import shlex
+import random
+import hashlib
+import json
+import collections
 from tasksocket import *
-from tasklog import tasklog
+from tasklog import tasklog, start_logger, stop_logger
+from taskloop import EventLoop
+from taskcapture import OutputPipe, TailBuffer, open_logfile
+from taskstats import read_usage, read_start_ticks, format_bytes
+from taskjournal import Journal, set_subreaper, watch_pid
+from taskmetrics import Counter, Gauge, Histogram, MetricsServer, BATCH_BUCKETS, METRICS_PORT, render
+from tasklimits import rlimit_options, cgroup_options, parse_rlimit, parse_nice, parse_ionice, parse_cpus, cgroup_path, apply_limits
+from taskhealth import ProbeScheduler, parse_healthcheck
+from tasklisten import parse_listen, bind_listener, close_listener, pass_listeners
 
 CONFIGFILE = './taskmaster.conf'
 
-process_state = ['STOPPED', 'RUNNING', 'EXITED', 'STOPPING' ,'FATAL']
+process_state = tuple(sys.intern(state) for state in ('STOPPED', 'STARTING', 'BACKOFF', 'RUNNING', 'EXITED', 'STOPPING' ,'FATAL'))
+
+running_states = frozenset(['STARTING', 'BACKOFF', 'RUNNING'])
 
 options_sample = [
         'command',
@@ -31,332 +45,1727 @@ options_sample = [
         'umask',
         'stdout',
         'stderr',
-        'directory'
+        'directory',
+        'capture',
+        'stdout_maxbytes',
+        'stdout_backups',
+        'stderr_maxbytes',
+        'stderr_backups',
+        'priority',
+        'depends_on',
+        'start_concurrency',
+        'backoff_base',
+        'backoff_max',
+        'backoff_jitter',
+        'rlimit_nofile',
+        'rlimit_as',
+        'rlimit_core',
+        'nice',
+        'ionice',
+        'cpu_affinity',
+        'cpu_pin',
+        'cgroup',
+        'memory_max',
+        'cpu_max',
+        'healthcheck',
+        'healthcheck_interval',
+        'healthcheck_timeout',
+        'healthcheck_threshold',
+        'ready_timeout',
+        'listen',
+        'numprocs_min',
+        'numprocs_max',
+        'scale_metric',
+        'scale_up',
+        'scale_down',
+        'scale_cooldown'
         ]
 
 stop_signals = {
-        'SIGTERM': 15,
-        'SIGHUP': 1,
-        'SIGINT': 2,
-        'SIGQUIT': 3,
-        'SIGKILL': 9,
-        'SIGUSR1': 30,
-        'SIGUSR2': 31
+        'SIGTERM': signal.SIGTERM,
+        'SIGHUP': signal.SIGHUP,
+        'SIGINT': signal.SIGINT,
+        'SIGQUIT': signal.SIGQUIT,
+        'SIGKILL': signal.SIGKILL,
+        'SIGUSR1': signal.SIGUSR1,
+        'SIGUSR2': signal.SIGUSR2
+        }
+
+spec_defaults = {
+        'command': '',
+        'numprocs': '1',
+        'startsecs': '1',
+        'startretries': '3',
+        'autostart': 'true',
+        'autorestart': 'unexpected',
+        'exitcodes': '0',
+        'stopsignal': 'SIGTERM',
+        'stopwaitsecs': '10',
+        'environment': '',
+        'umask': '022',
+        'directory': './',
+        'stdout': '/tmp/task_stdout.log',
+        'stderr': '/tmp/task_stderr.log',
+        'capture': 'false',
+        'stdout_maxbytes': str(50 * 1024 * 1024),
+        'stdout_backups': '10',
+        'stderr_maxbytes': str(50 * 1024 * 1024),
+        'stderr_backups': '10',
+        'priority': '999',
+        'depends_on': '',
+        'start_concurrency': '0',
+        'backoff_base': '1',
+        'backoff_max': '60',
+        'backoff_jitter': '0.2',
+        'nice': '',
+        'ionice': '',
+        'cpu_affinity': '',
+        'cpu_pin': 'false',
+        'cgroup': '',
+        'healthcheck': '',
+        'healthcheck_interval': '5',
+        'healthcheck_timeout': '2',
+        'healthcheck_threshold': '3',
+        'ready_timeout': '60',
+        'listen': '',
+        'numprocs_min': '1',
+        'numprocs_max': '',
+        'scale_metric': 'cpu',
+        'scale_up': '75',
+        'scale_down': '25',
+        'scale_cooldown': '30'
         }
 
+# [taskmasterd] section: settings of the daemon itself, reread on reload
+daemon_options = [
+        'sample_interval',
+        'start_concurrency'
+        ]
+
+# only decide how many instances run: changing them never restarts a program
+scale_options = frozenset(['numprocs', 'numprocs_min', 'numprocs_max', 'scale_metric', 'scale_up', 'scale_down',
+        'scale_cooldown'])
+
+limit_parsers = {
+        'rlimit_nofile': parse_rlimit,
+        'rlimit_as': parse_rlimit,
+        'rlimit_core': parse_rlimit,
+        'nice': parse_nice,
+        'ionice': parse_ionice,
+        'cpu_affinity': parse_cpus
+        }
+
+START_CONCURRENCY = 0    # instances allowed in flight (not RUNNING yet) while booting, 0 for no limit,
+                         # unless [taskmasterd] sets start_concurrency
+
+SAMPLE_INTERVAL = 2.0    # seconds between /proc samples of the RUNNING children, unless [taskmasterd] sets sample_interval
+
+SAMPLE_CHUNK = 256       # pids read per loop iteration, so a large fleet doesn't stall the loop for a whole pass
+
+ADOPT_POLL = 1.0         # liveness poll of adopted children where pidfds are not available
+
+SUBSCRIBE_QUEUE = 1024   # events held per subscriber while its socket is backed up, oldest dropped first
+
+SUBSCRIBE_RETRY = 0.05   # seconds before retrying delivery to a backed up subscriber
+
+READY_POLL = 0.5         # seconds between readiness probes of a STARTING process with a healthcheck
+
 processes = dict()
 
+base_env = dict(os.environ)   # copied once, shared by every program that sets no environment
+
+sample_interval = SAMPLE_INTERVAL
+
+start_concurrency = START_CONCURRENCY
+
+sections = dict()   # title -> ProgramSpec of the loaded configuration
+
+pids = dict()   # pid -> (process, generation) for every child not reaped yet
+
+loop = None
+
+probes = None   # ProbeScheduler running the healthchecks of every instance
+
+quitting = False
+
+quit_client = None
+
+followers = dict()  # connection -> (tail buffer, callback) of its running 'tail -f'
+
+journal = Journal()
+
+watchers = dict()   # pid -> pidfd of a child adopted from a previous daemon
+
+subscribers = dict()    # connection -> Subscriber of its 'subscribe' stream
+
+listeners = dict()  # listen address -> socket bound once by the daemon, passed to every instance
+
+scaled_at = dict()  # title -> monotonic time of its last autoscaling step
+
+text_commands = ('status', 'start', 'stop', 'restart', 'rolling-restart', 'reload', 'pid', 'tail', 'untail', 'subscribe', 'unsubscribe',
+        'metrics', 'exit', 'quit')
+
+
+# Metrics, served by the 'metrics' command and on METRICS_PORT
+
+def processes_by_state():
+    counts = dict.fromkeys(process_state, 0)
+    for proc in processes.values():
+        counts[proc.state] += 1
+    return [((state,), count) for state, count in counts.items()]
+
+spawns_total = Counter('taskmaster_spawns_total', 'Processes spawned.', ('program',))
+exits_total = Counter('taskmaster_exits_total', 'Children reaped, by exit code or killing signal.', ('program', 'code'))
+backoffs_total = Counter('taskmaster_backoffs_total', 'Exits before startsecs that were retried.', ('program',))
+fatals_total = Counter('taskmaster_fatals_total', 'Programs that ran out of start retries.', ('program',))
+kills_total = Counter('taskmaster_stop_kills_total', 'Children sent SIGKILL after stopwaitsecs.', ('program',))
+spawn_seconds = Histogram('taskmaster_spawn_seconds', 'Time spent in fork/posix_spawn.')
+stop_seconds = Histogram('taskmaster_stop_seconds', 'Time from the stop signal to the child being reaped.')
+reload_seconds = Histogram('taskmaster_reload_seconds', 'Time spent applying a configuration reload.')
+request_seconds = Histogram('taskmaster_request_seconds', 'Time the loop spent handling a control request.', labels=('protocol', 'command'))
+sigchld_batch = Histogram('taskmaster_sigchld_batch_size', 'Children reaped per SIGCHLD wakeup.', BATCH_BUCKETS)
+events_dropped_total = Counter('taskmaster_events_dropped_total', 'State events dropped for slow subscribers.')
+probe_failures_total = Counter('taskmaster_healthcheck_failures_total', 'Failed healthcheck probes.', ('program',))
+unhealthy_total = Counter('taskmaster_unhealthy_restarts_total', 'Processes restarted after failing healthcheck_threshold probes in a row.', ('program',))
+scale_total = Counter('taskmaster_scale_events_total', 'Instances added or removed by the autoscaler.', ('program', 'direction'))
+unready_total = Counter('taskmaster_unready_kills_total', 'Processes killed for not passing a healthcheck within ready_timeout.', ('program',))
+processes_gauge = Gauge('taskmaster_processes', 'Processes by state.', processes_by_state, ('state',))
+
+# Program specification: a config section compiled once, shared by its instances
+
+class ProgramSpec():
+    __slots__ = ('title', 'options', 'config', 'key', 'digest', 'command', 'argv', 'numprocs', 'autostart',
+            'autorestart', 'exitcodes', 'startsecs', 'startretries', 'stopsignal', 'stopsignal_name',
+            'stopwaitsecs', 'backoff_base', 'backoff_max', 'backoff_jitter', 'env', 'spawn_env', 'umask', 'directory', 'direct_spawn', 'stdout', 'stderr',
+            'capture', 'maxbytes', 'backups', 'file_actions', 'priority', 'depends_on', 'start_concurrency',
+            'rlimits', 'nice', 'ionice', 'cpus', 'cpu_pin', 'cgroup', 'cgroup_limits', 'healthcheck',
+            'healthcheck_interval', 'healthcheck_timeout', 'healthcheck_threshold', 'ready_timeout', 'listen',
+            'numprocs_min', 'numprocs_max', 'autoscale', 'scale_metric', 'scale_up', 'scale_down', 'scale_cooldown')
+    def __init__(self, title, options):
+        raw = dict(spec_defaults)
+        raw.update(options)
+        env = dict()
+        for var in raw['environment'].split(','):
+            if var:
+                pair = var.split(':', 1)
+                env[pair[0]] = pair[1].replace("\"", "")
+        spawn_env = base_env
+        if env:
+            spawn_env = dict(base_env)
+            spawn_env.update(env)
+        options = tuple(sorted(options.items()))
+        config = tuple(item for item in options if item[0] not in scale_options)
+        digest = hashlib.sha1(repr(config).encode()).hexdigest()[:16]   # stable across daemon runs
+        fields = {
+                'title': title,
+                'options': options,
+                'config': config,
+                'key': int(digest, 16),
+                'digest': digest,
+                'command': raw['command'],
+                'argv': tuple(shlex.split(raw['command'])),
+                'numprocs': int(raw['numprocs']),
+                'numprocs_min': int(raw['numprocs_min']),
+                'numprocs_max': int(raw['numprocs_max'] or raw['numprocs']),
+                'autoscale': bool(raw['numprocs_max']),
+                'scale_metric': raw['scale_metric'].partition(':')[::2],
+                'scale_up': float(raw['scale_up']),
+                'scale_down': float(raw['scale_down']),
+                'scale_cooldown': float(raw['scale_cooldown']),
+                'autostart': raw['autostart'] == 'true',
+                'autorestart': raw['autorestart'],
+                'exitcodes': frozenset(int(code) for code in raw['exitcodes'].split(',') if code.strip()),
+                'startsecs': int(raw['startsecs']),
+                'startretries': int(raw['startretries']),
+                'stopsignal': stop_signals[raw['stopsignal']],
+                'stopsignal_name': raw['stopsignal'],
+                'stopwaitsecs': int(raw['stopwaitsecs']),
+                'backoff_base': float(raw['backoff_base']),
+                'backoff_max': float(raw['backoff_max']),
+                'backoff_jitter': float(raw['backoff_jitter']),
+                'env': env,
+                'spawn_env': spawn_env,
+                'umask': int(raw['umask'], 8),
+                'directory': raw['directory'],
+                'direct_spawn': False,
+                'stdout': raw['stdout'],
+                'stderr': raw['stderr'],
+                'capture': raw['capture'] == 'true',
+                'maxbytes': {'stdout': int(raw['stdout_maxbytes']), 'stderr': int(raw['stderr_maxbytes'])},
+                'backups': {'stdout': int(raw['stdout_backups']), 'stderr': int(raw['stderr_backups'])},
+                'file_actions': None,
+                'priority': int(raw['priority']),
+                'depends_on': tuple(title.strip() for title in raw['depends_on'].split(',') if title.strip()),
+                'start_concurrency': int(raw['start_concurrency']),
+                'rlimits': tuple((limit, parse_rlimit(raw[option])) for option, limit in rlimit_options.items() if option in raw),
+                'nice': parse_nice(raw['nice']) if raw['nice'] else None,
+                'ionice': parse_ionice(raw['ionice']) if raw['ionice'] else None,
+                'cpus': parse_cpus(raw['cpu_affinity']) if raw['cpu_affinity'] else None,
+                'cpu_pin': raw['cpu_pin'] == 'true',
+                'cgroup': cgroup_path(raw['cgroup']) if raw['cgroup'] else None,
+                'cgroup_limits': tuple((control, raw[option]) for option, control in cgroup_options.items() if option in raw),
+                'healthcheck': parse_healthcheck(raw['healthcheck']) if raw['healthcheck'] else None,
+                'healthcheck_interval': float(raw['healthcheck_interval']),
+                'healthcheck_timeout': float(raw['healthcheck_timeout']),
+                'healthcheck_threshold': int(raw['healthcheck_threshold']),
+                'ready_timeout': int(raw['ready_timeout']),
+                'listen': parse_listen(raw['listen']) if raw['listen'] else ()
+                }
+        if fields['autoscale']:
+            fields['numprocs'] = min(max(fields['numprocs'], fields['numprocs_min']), fields['numprocs_max'])
+        # limits and LISTEN_PID are set in a forked child before exec, posix_spawn has no hook for them
+        confined = (fields['rlimits'] or fields['nice'] is not None or fields['ionice'] or fields['cpus'] or fields['cgroup']
+                or fields['listen'])
+        fields['direct_spawn'] = not confined and os.path.realpath(raw['directory']) == os.getcwd()
+        if not fields['capture']:
+            file_actions = []
+            for fd, stream in ((1, 'stdout'), (2, 'stderr')):
+                if fields[stream] == 'NONE':
+                    file_actions.append((os.POSIX_SPAWN_CLOSE, fd))
+                else:
+                    file_actions.append((os.POSIX_SPAWN_OPEN, fd, fields[stream], os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o777))
+            fields['file_actions'] = tuple(file_actions)
+        for name, value in fields.items():
+            object.__setattr__(self, name, value)
+    def __setattr__(self, name, value):
+        raise AttributeError('ProgramSpec is immutable')
+    def __eq__(self, other):
+        if not isinstance(other, ProgramSpec):
+            return NotImplemented
+        return self is other or (self.key == other.key and self.title == other.title and self.config == other.config)
+    def __hash__(self):
+        return self.key
+
+
 # Main Class
 
+# Runtime state only: the config lives in the shared spec, unused fields hold shared constants
+
 class Process():
-    def __init__(self, name):
-        self.title = str()
-        self.name = name
-        self.command = str()
-        self.numprocs =  1
-        self.startsecs = 1
-        self.startretries = 3
-        self.autostart =  'true'
-        self.autorestart =  'unexpected'
-        self.exitcodes = '0'
-        self.stopsignal = 'SIGTERM'
-        self.stopwaitsecs = 10
-        self.environment = str()
-        self.umask = '022'
-        self.directory = './'
-        self.stdout = '/tmp/task_stdout.log'
-        self.stderr = '/tmp/task_stderr.log'
-        self.pid = int()
+    __slots__ = ('name', 'spec', 'pid', 'generation', 'state', 'description', 'retries_counter',
+            'startime', 'stopdeadline', 'timer', 'restart', 'successor', 'tail', 'waiters', 'exit', 'termsig', 'usage',
+            'ticks', 'failures')
+    def __init__(self, name, spec):
+        self.name = sys.intern(name)
+        self.spec = spec
+        self.pid = 0
+        self.generation = 0
         self.state = 'STOPPED'
         self.description = 'Program not started yet !'
         self.retries_counter = 0
-        self.startime = float()
-        self.exit = int()
+        self.startime = 0.0
+        self.stopdeadline = 0.0
+        self.timer = None
+        self.restart = False
+        self.successor = None
+        self.tail = None
+        self.waiters = None
+        self.exit = 0
+        self.termsig = 0    # signal that killed the last exit, 0 if it exited on its own
+        self.usage = None
+        self.ticks = None
+        self.failures = 0
     def __eq__(self, other):
-        return (self.name == other.name and self.command == other.command and self.numprocs == other.numprocs
-        and self.startsecs == other.startsecs and self.startretries == other.startretries
-        and self.autostart == other.autostart and self.autorestart == other.autorestart and self.exitcodes == other.exitcodes
-        and self.stopsignal == other.stopsignal and self.stopwaitsecs == other.stopwaitsecs
-        and self.environment == other.environment and  self.umask == other.umask and self.directory == other.directory
-        and self.stdout == other.stdout and self.stderr == other.stderr)
+        return self.name == other.name and self.spec == other.spec
+    @property
+    def title(self):
+        return self.spec.title
     def start(self): 
+        if quitting:
+            return False
         self.startime = time.time()
         try:
-            self.pid = os.fork()
-        except BlockingIOError as err:
-            pass
-        if self.pid == 0:
-            self._env()
-            self._redirect()
-            os.umask(int(self.umask))
-            try:
-                os.chdir(self.directory)
-            except FileNotFoundError:
-                sys.stderr.write(self.name + ":" + self.directory + " : Directory name Not Found!\n")
-            cmd = self.command.split(' ')
-            try:
-                time.sleep(1)
-                os.execv(cmd[0], cmd)
-            except FileNotFoundError:
-                sys.stderr.write(self.name + ":" + self.command + " : Program name Not Found!\n")
-                sys.exit(127)
-        elif self.pid > 0:
-            if self.state != 'RUNNING': 
+            listening = [bind_listeners(address) for address in self.spec.listen]
+        except OSError as err:
+            self.description = 'Could not listen on ' + ', '.join(self.spec.listen) + ': ' + err.strerror
+            tasklog('SPAWNERR', self.name, self.description)
+            return False
+        pipes = dict()
+        begin = time.perf_counter()
+        try:
+            self._pipes(pipes)   # EMFILE lands here too, as a failed start
+            pid = self._spawn(pipes, listening)
+        except OSError as err:
+            for read_fd, write_fd in pipes.values():
+                os.close(read_fd)
+                os.close(write_fd)
+            self.description = 'Could not fork: ' + err.strerror
+            tasklog('SPAWNERR', self.name, self.description)
+            return False
+        else:
+            spawn_seconds.observe(time.perf_counter() - begin)
+            spawns_total.inc(self.spec.title)
+            self.pid = pid
+            self.ticks = read_start_ticks(pid)
+            self.generation += 1
+            pids[pid] = (self, self.generation)
+            self._capture(pipes)
+            if self.state not in ('STARTING', 'BACKOFF'):
                 self.retries_counter = 0
-            state_handler(self, 'RUNNING')
-    def stop(self):                                            
+            state_handler(self, 'STARTING')
+            return True
+    def stop(self):
         state_handler(self, 'STOPPING')
+        self.stopdeadline = time.time() + self.spec.stopwaitsecs
+        if self.pid not in pids:   # exit already reaped, nothing left to signal
+            state_handler(self, 'STOPPED')
+            return
         try:
-            os.kill(self.pid, stop_signals[self.stopsignal])        
-            time.sleep(float(self.stopwaitsecs))
-            if self.state == 'STOPPING':
-                tasklog('KILL', self.name, '')
-                os.kill(self.pid, stop_signals['SIGKILL'])
-            else:
-                tasklog('STOP', self.name, self.stopsignal)
+            os.kill(self.pid, self.spec.stopsignal)
         except ProcessLookupError:
             pass
-    def _redirect(self):
+        self._set_timer(self.spec.stopwaitsecs, stop_timeout, self.generation)
+    def _set_timer(self, delay, callback, *args):
+        if self.timer:
+            self.timer.cancel()
+        self.timer = loop.call_later(delay, callback, self, *args)
+    def _pipes(self, pipes):
+        if self.spec.capture:
+            for stream in ('stdout', 'stderr'):
+                if getattr(self.spec, stream) != 'NONE':
+                    pipes[stream] = os.pipe()
+    def _capture(self, pipes):
+        for stream, (read_fd, write_fd) in pipes.items():
+            os.close(write_fd)
+            path = getattr(self.spec, stream).replace('{name}', self.name)
+            logfile = open_logfile(path, self.spec.maxbytes[stream], self.spec.backups[stream])
+            if not self.tail:
+                self.tail = TailBuffer()
+            OutputPipe(loop, read_fd, logfile, self.tail.append)
+    def _spawn(self, pipes, listening):
+        if hasattr(os, 'posix_spawn') and self.spec.direct_spawn:
+            try:
+                return self._posix_spawn(pipes)
+            except OSError:
+                pass   # the fork path reports the failure from the child, as a failed start
+        return self._fork_exec(pipes, listening)
+    def _posix_spawn(self, pipes):
+        # no copy of the daemon's address space; posix_spawn has no chdir, hence the cwd check above
+        spec = self.spec
+        file_actions = spec.file_actions
+        if file_actions is None:
+            file_actions = []
+            for fd, stream in ((1, 'stdout'), (2, 'stderr')):
+                if stream in pipes:
+                    file_actions.append((os.POSIX_SPAWN_DUP2, pipes[stream][1], fd))
+                else:
+                    file_actions.append((os.POSIX_SPAWN_CLOSE, fd))
+        mask = os.umask(spec.umask)
+        try:
+            return os.posix_spawn(spec.argv[0], spec.argv, spec.spawn_env, file_actions=file_actions,
+                    setsigdef=(signal.SIGPIPE, signal.SIGXFSZ))
+        finally:
+            os.umask(mask)
+    def _fork_exec(self, pipes, listening):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+                signal.signal(signal.SIGXFSZ, signal.SIG_DFL)
+                self._redirect(pipes)
+                env = pass_listeners(listening, self.spec.spawn_env) if listening else self.spec.spawn_env
+                os.umask(self.spec.umask)
+                try:
+                    os.chdir(self.spec.directory)
+                except FileNotFoundError:
+                    sys.stderr.write(self.name + ":" + self.spec.directory + " : Directory name Not Found!\n")
+                try:
+                    apply_limits(self.spec, instance_index(self.name))
+                except (OSError, ValueError) as err:
+                    sys.stderr.write(self.name + ": could not apply resource limits: " + str(err) + "\n")
+                else:
+                    try:
+                        os.execve(self.spec.argv[0], self.spec.argv, env)
+                    except (FileNotFoundError, IndexError):
+                        sys.stderr.write(self.name + ":" + self.spec.command + " : Program name Not Found!\n")
+                sys.stderr.flush()
+            finally:
+                os._exit(127)
+        return pid
+    def _redirect(self, pipes):
+        if pipes:
+            for fd, stream in ((1, 'stdout'), (2, 'stderr')):
+                if stream in pipes:
+                    os.dup2(pipes[stream][1], fd)
+                else:
+                    os.close(fd)
+            return
         try:
-            if self.stdout == 'NONE':
+            if self.spec.stdout == 'NONE':
                 os.close(1)
             else:
-                stdout_fd = os.open(self.stdout, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+                stdout_fd = os.open(self.spec.stdout, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
                 os.dup2(stdout_fd, 1)
         except OSError as err:
             if err.errno == errno.EACCES:
                 tasklog('EACCES', 'configfile', '')
                 os.dup2(os.open("/dev/null", os.O_WRONLY), 1)
         try:
-            if self.stderr == 'NONE':
+            if self.spec.stderr == 'NONE':
                 os.close(2)
             else:
-                stderr_fd = os.open(self.stderr, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+                stderr_fd = os.open(self.spec.stderr, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
                 os.dup2(stderr_fd, 2)
         except OSError as err:
             if err.errno == errno.EACCES:
                 tasklog('EACCES','configfile', '')
                 os.dup2(os.open("/dev/null", os.O_WRONLY), 2)
-    def _env(self):
-        env = self.environment.split(',')
-        if env[0]:
-            for var in env:
-                pair = var.split(':')
-                os.environ[pair[0]] = pair[1].replace("\"", "")
 
 
-# Signals Handling
+# Signals Handling: handlers only enqueue, the event loop dispatches
 
 def set_signals():
-    signal.signal(signal.SIGCHLD, sig_handler)
-    signal.signal(signal.SIGHUP, sig_handler)
+    loop.add_signal(signal.SIGCHLD, reap_children)
+    loop.add_signal(signal.SIGHUP, reload_request)
 
 
-def sig_handler(sig, frame):
-    if sig == signal.SIGCHLD:
-        while True:
-            try:
-                status = os.waitpid(-1, os.WNOHANG)
-            except ChildProcessError as err:
-                break
-            if status[0] <= 0:
-                break
-            pid = status[0]
-            exitcode = os.WEXITSTATUS(status[1])
-            for proc in processes.values():
-                if proc.pid == pid:
-                    proc.exit = exitcode
-                    if proc.state == 'STOPPING':
-                        state_handler(proc,'STOPPED')
-                    else:
-                        state_handler(proc, 'EXITED')
-    elif sig == signal.SIGHUP:  #reload 
-        reload_request()
-       
+def reap_children():
+    reaped = 0
+    while True:
+        try:
+            status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError as err:
+            break
+        if status[0] <= 0:
+            break
+        pid = status[0]
+        reaped += 1
+        child_exited(pid, status[1])
+    if reaped:
+        sigchld_batch.observe(reaped)
+    if quitting and not pids:
+        loop.stop()
+
+
+def child_exited(pid, status):
+    if probes and probes.child_exited(pid, status):
+        return
+    pidfd = watchers.pop(pid, None)
+    if pidfd is not None:
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+    proc, generation = pids.pop(pid, (None, 0))
+    if not proc or proc.generation != generation:
+        return   # not ours, or a late exit of a previous incarnation
+    exits_total.inc(proc.title, 'unknown' if status is None else exit_label(status))
+    proc.usage = None
+    proc.exit = -1 if status is None else os.WEXITSTATUS(status)
+    proc.termsig = os.WTERMSIG(status) if status is not None and os.WIFSIGNALED(status) else 0
+    if proc.state == 'STOPPING':
+        state_handler(proc,'STOPPED')
+    else:
+        state_handler(proc, 'EXITED')
+
+
+def exit_label(status):
+    if os.WIFSIGNALED(status):
+        return signal_name(os.WTERMSIG(status))
+    return str(os.WEXITSTATUS(status))
+
+
+def signal_name(signum):
+    try:
+        return signal.Signals(signum).name
+    except ValueError:
+        return 'signal ' + str(signum)
+
+
+# Resource usage: a batched pass over the RUNNING children, SAMPLE_CHUNK pids per
+# loop iteration; status reads the cached samples
+
+def sample_processes():
+    batch = [(pid, proc, generation) for pid, (proc, generation) in pids.items() if proc.state == 'RUNNING']
+    sample_chunk(batch, 0)
+
+def sample_chunk(batch, start):
+    now = time.monotonic()
+    for pid, proc, generation in batch[start:start + SAMPLE_CHUNK]:
+        if proc.generation == generation and proc.state == 'RUNNING':
+            proc.usage = read_usage(pid, now, proc.usage)
+    start += SAMPLE_CHUNK
+    if start < len(batch):
+        loop.call_soon(sample_chunk, batch, start)   # the rest after the sockets had their turn
+        return
+    autoscale(now)
+    loop.call_later(sample_interval, sample_processes)
+
+
+# Autoscaling: after each sample, a pool whose load per instance is above
+# scale_up (below scale_down) gains (loses) one instance, at most once per
+# scale_cooldown and never while a previous step is still starting up
+
+def autoscale(now):
+    if quitting:
+        return
+    for title, spec in sections.items():
+        if not spec.autoscale or now - scaled_at.get(title, float('-inf')) < spec.scale_cooldown:
+            continue
+        instances = [proc for proc in processes.values() if proc.title == title]
+        if any(proc.state in ('STARTING', 'BACKOFF', 'STOPPING') for proc in instances):
+            continue
+        load = scale_load(spec, instances)
+        if load is None:
+            continue
+        count = len(instances)
+        if load > spec.scale_up and count < spec.numprocs_max:
+            scale_program(spec, instances, count + 1, load)
+        elif load < spec.scale_down and count > spec.numprocs_min:
+            scale_program(spec, instances, count - 1, load)
+        else:
+            continue
+        scaled_at[title] = now
+
+def scale_load(spec, instances):
+    kind, path = spec.scale_metric
+    if kind == 'cpu':
+        samples = [proc.usage.cpu for proc in instances
+                if proc.state == 'RUNNING' and proc.usage and proc.usage.cpu is not None]
+        return sum(samples) / len(samples) if samples else None
+    try:
+        with open(path) as depth:
+            return float(depth.read().split()[0]) / max(len(instances), 1)   # queue depth per instance
+    except (OSError, IndexError, ValueError):
+        return None
+
+def scale_program(spec, instances, count, load):
+    direction = 'up' if count > len(instances) else 'down'
+    tasklog('SCALE', spec.title, str(len(instances)) + ' -> ' + str(count) + ' instances at ' + '%.1f' % load)
+    scale_total.inc(spec.title, direction)
+    instances.sort(key=lambda proc: instance_index(proc.name))
+    if direction == 'up':
+        used = set(instance_index(proc.name) for proc in instances)
+        index = min(set(range(count)) - used)
+        proc = create_process(spec.title, index, count, spec)
+        processes[proc.name] = proc
+        if spec.autostart:
+            start_program(proc)
+    else:
+        proc = instances[-1]
+        remove_process(proc)
+        del processes[proc.name]
+    compact_journal()
+
+
+# State journal: every transition is appended, a restarted daemon re-adopts
+# the live pids it finds there instead of spawning them again
+
+def journal_record(proc):
+    return {'name': proc.name, 'pid': proc.pid, 'ticks': proc.ticks, 'start': proc.startime,
+            'retries': proc.retries_counter, 'spec': proc.spec.digest, 'state': proc.state}
+
+def journal_transition(proc):
+    if journal.append(journal_record(proc)):
+        compact_journal()
+
+def compact_journal():
+    journal.compact([journal_record(proc) for proc in processes.values()])
+
+def adopt_processes():
+    for name, record in journal.load().items():
+        pid = record.get('pid')
+        if not pid or not record.get('ticks') or read_start_ticks(pid) != record['ticks']:
+            continue   # gone, or the pid now belongs to something else
+        title = name.rpartition(':')[0]
+        spec = sections.get(title)
+        if name not in processes and spec and spec.autoscale and instance_index(name) < spec.numprocs_max:
+            processes[name] = create_process(title, instance_index(name), spec.numprocs_max, spec)   # added by the autoscaler
+        if name in processes:
+            adopt(processes[name], pid, record)
+            continue
+        tasklog('ORPHAN', name, str(pid))
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    compact_journal()
+
+def adopt(proc, pid, record):
+    proc.pid = pid
+    proc.ticks = record['ticks']
+    proc.startime = record.get('start') or time.time()
+    proc.retries_counter = record.get('retries') or 0
+    proc.generation += 1
+    pids[pid] = (proc, proc.generation)
+    pidfd = watch_pid(pid)
+    if pidfd is not None:
+        watchers[pid] = pidfd
+        loop.add_reader(pidfd, adopted_exited, pid)
+    else:
+        loop.call_later(ADOPT_POLL, poll_adopted, proc, proc.generation)
+    tasklog('ADOPT', proc.name, str(pid))
+    set_state(proc, 'RUNNING', pid, 'Process adopted with pid: ' + str(pid))
+    if proc.spec.healthcheck:
+        schedule_probe(proc, proc.spec.healthcheck_interval)
+    if proc.spec.digest != record.get('spec') or proc.spec.capture or any(address.startswith('unix:') for address in proc.spec.listen):
+        # its config changed, or its output pipe or unix listener died with the previous daemon
+        proc.restart = True
+        proc.stop()
+
+def adopted_exited(pid):
+    try:
+        wpid, status = os.waitpid(pid, os.WNOHANG)
+    except ChildProcessError:
+        wpid, status = pid, None   # not our child, its exit status went to its real parent
+    if wpid:
+        child_exited(pid, status)
+    if quitting and not pids:
+        loop.stop()
+
+def poll_adopted(proc, generation):
+    if proc.generation != generation or not proc.pid:
+        return
+    if read_start_ticks(proc.pid) != proc.ticks:
+        adopted_exited(proc.pid)
+    else:
+        loop.call_later(ADOPT_POLL, poll_adopted, proc, generation)
+
+
+# Timers: startsecs before RUNNING, SIGKILL after stopwaitsecs
+
+def start_timeout(proc, generation):
+    proc.timer = None
+    if proc.state == 'STARTING' and proc.generation == generation:
+        state_handler(proc, 'RUNNING')
+
+
+def retry_start(proc, generation):
+    if proc.state == 'BACKOFF' and proc.generation == generation:
+        if not proc.start() and not quitting:
+            start_failed(proc, 0, proc.description, 'none')
+            journal_transition(proc)
+
+
+# base * 2^n capped at backoff_max, spread by +/- backoff_jitter so a fleet doesn't retry in lockstep
+
+def backoff_delay(proc):
+    spec = proc.spec
+    delay = min(spec.backoff_base * 2 ** (proc.retries_counter - 1), spec.backoff_max)
+    delay *= random.uniform(1 - spec.backoff_jitter, 1 + spec.backoff_jitter)
+    return min(delay, spec.backoff_max)
+
+
+def stop_timeout(proc, generation):
+    proc.timer = None
+    if proc.state == 'STOPPING' and proc.generation == generation and proc.pid in pids:
+        tasklog('KILL', proc.name, '')
+        kills_total.inc(proc.title)
+        try:
+            os.kill(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+# Healthchecks: one probe chain per incarnation, readiness while STARTING,
+# liveness while RUNNING; a stale generation or a settled state ends the chain
+
+def schedule_probe(proc, delay):
+    loop.call_later(delay, run_probe, proc, proc.generation)
+
+
+def run_probe(proc, generation):
+    if proc.generation != generation or proc.state not in ('STARTING', 'RUNNING'):
+        return
+    spec = proc.spec
+    kind, target = spec.healthcheck
+    target = target.replace('{name}', proc.name).replace('{index}', str(instance_index(proc.name)))
+    probes.submit(kind, target, spec.healthcheck_timeout, spec.healthcheck_interval + spec.healthcheck_timeout,
+            probe_result, proc, generation)
+
+
+def probe_result(ok, detail, proc, generation):
+    if proc.generation != generation or proc.state not in ('STARTING', 'RUNNING'):
+        return
+    spec = proc.spec
+    if ok:
+        if proc.failures:
+            proc.description = 'Healthcheck passing again after ' + str(proc.failures) + ' failures'
+        proc.failures = 0
+        if proc.state == 'STARTING':
+            tasklog('READY', proc.name, str(proc.pid))
+            state_handler(proc, 'RUNNING')
+            proc.description = 'Process ready with pid: ' + str(proc.pid)
+    elif proc.state == 'RUNNING':
+        proc.failures += 1
+        probe_failures_total.inc(proc.title)
+        proc.description = ('Healthcheck failed ' + str(proc.failures) + '/' + str(spec.healthcheck_threshold)
+                + ': ' + detail)
+        if proc.failures >= spec.healthcheck_threshold:
+            tasklog('UNHEALTHY', proc.name, detail)
+            unhealthy_total.inc(proc.title)
+            proc.restart = True
+            proc.stop()   # stopsignal, then SIGKILL after stopwaitsecs if it is hung
+            return
+    schedule_probe(proc, READY_POLL if proc.state == 'STARTING' else spec.healthcheck_interval)
+
+
+def ready_timeout(proc, generation):
+    proc.timer = None
+    if proc.state == 'STARTING' and proc.generation == generation and proc.pid in pids:
+        tasklog('UNREADY', proc.name, str(proc.spec.ready_timeout) + 's')
+        unready_total.inc(proc.title)
+        try:
+            os.kill(proc.pid, signal.SIGKILL)   # its exit counts as a failed start
+        except ProcessLookupError:
+            pass
+
 
 # Process state handling
 
 def state_handler(proc, state):
+    if proc.timer:
+        proc.timer.cancel()
+        proc.timer = None
+    pid = proc.pid
+    if state in ('EXITED', 'STOPPED'):
+        proc.pid = 0
     if state == 'EXITED':
-        exec_time = int(time.time() - proc.startime) - 1
-        if proc.retries_counter < int(proc.startretries) and int(exec_time) < int(proc.startsecs):
-            tasklog('BACKOFF', proc.name, str(proc.exit))
-            proc.retries_counter += 1
-            proc.start()
-        elif proc.retries_counter == int(proc.startretries) and int(exec_time) < int(proc.startsecs):
-            tasklog('FATAL', proc.name, '')
-            proc.state = 'FATAL'
-            proc.description = 'Process could not be started successfully'
+        exec_time = int(time.time() - proc.startime)
+        if proc.state == 'STARTING' and not proc.spec.healthcheck and time.time() - proc.startime >= proc.spec.startsecs:
+            set_state(proc, 'RUNNING', pid)   # the exit beat the startsecs timer, it did start successfully
+        if proc.state == 'STARTING':
+            start_failed(proc, pid, 'Exited too quickly', str(proc.exit))
         else:     
             tasklog('EXIT', proc.name, str(proc.exit))
-            proc.state = 'EXITED'
-            proc.description = 'Process exited after: ' + str(int(exec_time)) + ' seconds'
-            if proc.autorestart == 'true':
-                proc.start()
-            elif proc.autorestart == 'unexpected' and str(proc.exit) not in list(proc.exitcodes.split(',')):
-                proc.start()
+            set_state(proc, 'EXITED', pid, 'Process exited after: ' + str(int(exec_time)) + ' seconds')
+            if proc.spec.autorestart == 'true' or (proc.spec.autorestart == 'unexpected'
+                    and proc.exit not in proc.spec.exitcodes):
+                if not proc.start() and not quitting:
+                    start_failed(proc, 0, proc.description, 'none')
     elif state == 'STOPPED':
-        proc.state = state
-        proc.description = 'Process stopped after a stop request'
-    elif state == 'RUNNING':
+        now = time.time()
+        stop_seconds.observe(max(now - (proc.stopdeadline - proc.spec.stopwaitsecs), 0))
+        if now < proc.stopdeadline:
+            tasklog('STOP', proc.name, proc.spec.stopsignal_name)
+        set_state(proc, state, pid, 'Process stopped after a stop request')
+        if proc.restart:
+            proc.restart = False
+            if not proc.start() and not quitting:
+                proc.retries_counter = 0
+                start_failed(proc, 0, proc.description, 'none')
+        elif proc.successor:
+            if proc.successor.spec.autostart and processes.get(proc.successor.name) is proc.successor:
+                proc.successor.start()
+            proc.successor = None
+    elif state == 'STARTING':
         tasklog('SPAWN', proc.name, str(proc.pid))
-        proc.state = state
-        proc.description = 'Process spawned with pid: ' + str(proc.pid)
+        if proc.spec.healthcheck:
+            # RUNNING once a probe passes instead of after startsecs
+            proc._set_timer(proc.spec.ready_timeout, ready_timeout, proc.generation)
+            schedule_probe(proc, READY_POLL)
+        else:
+            proc._set_timer(proc.spec.startsecs, start_timeout, proc.generation)
+        set_state(proc, state, pid, 'Process spawned with pid: ' + str(proc.pid))
+    elif state == 'RUNNING':
+        proc.retries_counter = 0
+        proc.failures = 0
+        set_state(proc, state, pid)
     elif state == 'STOPPING':
-        tasklog('WAITSTOP', proc.name, proc.stopsignal)
-        proc.state = state
-        proc.description = 'Process stopping with a signal'
+        tasklog('WAITSTOP', proc.name, proc.spec.stopsignal_name)
+        set_state(proc, state, pid, 'Process stopping with a signal')
+    journal_transition(proc)
+
+
+# A start attempt that failed, by exiting before startsecs or by not being
+# spawned at all: retried after a backoff until startretries, then FATAL
+
+def start_failed(proc, pid, reason, exitcode):
+    if proc.retries_counter < proc.spec.startretries:
+        proc.retries_counter += 1
+        backoffs_total.inc(proc.title)
+        delay = backoff_delay(proc)
+        tasklog('BACKOFF', proc.name, exitcode + ', retrying in ' + '%.1f' % delay + 's')
+        proc._set_timer(delay, retry_start, proc.generation)
+        set_state(proc, 'BACKOFF', pid, reason + ', retry ' + str(proc.retries_counter) + '/'
+                + str(proc.spec.startretries) + ' in ' + '%.1f' % delay + 's')
+    else:
+        tasklog('FATAL', proc.name, '')
+        fatals_total.inc(proc.title)
+        set_state(proc, 'FATAL', pid, 'Process could not be started successfully')
+
+
+# Every transition goes through here: waiters see each state, not only the
+# one a nested start() leaves behind (STOPPED then STARTING on a restart)
+
+def set_state(proc, state, pid, description=None):
+    old, proc.state = proc.state, state
+    if description is not None:
+        proc.description = description
+    notify_waiters(proc)
+    if subscribers:
+        event = {'time': round(time.time(), 6), 'name': proc.name, 'pid': pid or None,
+                'from': old, 'to': state, 'exitcode': None if proc.termsig else proc.exit,
+                'signal': signal_name(proc.termsig) if proc.termsig else None}
+        for subscriber in list(subscribers.values()):
+            subscriber.push(proc, event)
+
+
+# State event stream: each subscriber owns a bounded queue in front of its
+# connection, a slow reader loses the oldest events and is told how many
+
+class Subscriber():
+    def __init__(self, connection, targets):
+        self.connection = connection
+        self.names = set()
+        self.titles = set()
+        for target in targets:
+            if target == 'all':
+                self.names = self.titles = None
+                break
+            elif target.endswith(':*'):
+                self.titles.add(target[:-2])
+            else:
+                self.names.add(target)
+        self.queue = collections.deque()
+        self.dropped = 0
+        self.retry = None
+    def wants(self, proc):
+        return self.names is None or (not self.names and not self.titles) or proc.name in self.names or proc.title in self.titles
+    def push(self, proc, event):
+        if not self.wants(proc):
+            return
+        if len(self.queue) >= SUBSCRIBE_QUEUE:
+            self.queue.popleft()
+            self.dropped += 1
+            events_dropped_total.inc()
+        self.queue.append(event)
+        if not self.retry:
+            self.flush()
+    def flush(self):
+        self.retry = None
+        connection = self.connection
+        while self.queue and connection.pending <= HIGH_WATER and not connection.closed:
+            if self.dropped:
+                self.write({'type': 'dropped', 'count': self.dropped})
+                self.dropped = 0
+            self.write(self.queue.popleft())
+        if self.queue and not self.retry and not connection.closed:
+            self.retry = loop.call_later(SUBSCRIBE_RETRY, self.flush)
+    def write(self, event):
+        if self.connection.rpc:
+            self.connection.write_raw(json.dumps({'v': RPC_VERSION, 'event': event}, separators=(',', ':')).encode() + b'\n')
+        elif 'type' in event:
+            self.connection.send('[' + str(event['count']) + ' events dropped]')
+        else:
+            self.connection.send('%.3f %s %s -> %s pid %s exit %s' % (event['time'], event['name'], event['from'],
+                    event['to'], event['pid'] or '-', event['signal'] or event['exitcode']))
+    def close(self):
+        if self.retry:
+            self.retry.cancel()
+            self.retry = None
+
+
+def subscribe(connection, targets):
+    unsubscribe(connection)
+    subscribers[connection] = Subscriber(connection, targets)
+    if unsubscribe not in connection.close_callbacks:
+        connection.on_close(unsubscribe)
+
+def unsubscribe(connection):
+    subscriber = subscribers.pop(connection, None)
+    if subscriber:
+        subscriber.close()
+    return subscriber is not None
 
 
 # Command requests Handling
 
 def request_handler(daemon, request):
-    if len(request) == 2 and request[1] not in processes.keys():
-        daemon.send('No such program name ! type "status"')
+    if request[0] == 'tail':
+        tail_request(daemon, request)
+    elif request[0] == 'untail':
+        untail_request(daemon)
+    elif request[0] == 'subscribe':
+        subscribe_request(daemon, request[1:])
+    elif request[0] == 'unsubscribe':
+        unsubscribe_request(daemon)
+    elif request[0] in control_actions:
+        control_request(daemon, request[0], request[1:])
+    elif request[0] == 'rolling-restart':
+        rolling_restart_request(daemon, request[1:])
     elif request[0] == 'status':
-        status_request(daemon)
-    elif request[0] == 'start':
-        start_request(daemon, request[1])
-    elif request[0] == 'stop':
-        stop_request(daemon, request[1])
-    elif request[0] == 'restart':
-        restart_request(daemon, request[1])
+        status_request(daemon, request[1:])
+    elif request[0] == 'metrics':
+        daemon.send(render().rstrip('\n'))
+    elif len(request) == 2 and request[1] not in processes.keys():
+        daemon.send('No such program name ! type "status"')
     elif request[0] == 'reload':
         daemon.send('Reloading programs...')
-        reload_request()
-        daemon.send('Programs reloaded !') 
+        if reload_request():
+            daemon.send('Programs reloaded !') 
+        else:
+            daemon.send('Invalid configuration file, killing child processes and quitting')
     elif request[0] == 'pid':
         daemon.send(str(os.getpid()))
     elif request[0] == 'exit':
-        daemon.close_connection()
+        daemon.close()
+        return
     elif request[0] == 'quit':
         quit_request(daemon)
-    daemon.send(END)
 
-def status_request(daemon):
-    for proc in processes.values():
-        daemon.send(proc.name  + '  '  + proc.state + '   ' + proc.description) 
+def status_request(daemon, options):
+    if options == ['-v']:
+        for proc in processes.values():
+            daemon.send(proc.name + '  ' + proc.state + '   ' + usage_summary(proc) + '   ' + proc.description)
+    elif options:
+        daemon.send('status: [-v]')
+    else:
+        for proc in processes.values():
+            daemon.send(proc.name  + '  '  + proc.state + '   ' + proc.description) 
+
+def usage_summary(proc):
+    usage = proc.usage
+    if not proc.pid or usage is None:
+        return 'pid - cpu - rss - fds - uptime -'
+    cpu = '-' if usage.cpu is None else str(usage.cpu) + '%'
+    fds = '-' if usage.fds is None else str(usage.fds)
+    uptime = int(time.time() - proc.startime)
+    return ('pid ' + str(proc.pid) + ' cpu ' + cpu + ' rss ' + format_bytes(usage.rss) + ' fds ' + fds
+            + ' uptime ' + '%d:%02d:%02d' % (uptime // 3600, uptime // 60 % 60, uptime % 60))
+
+def control_request(daemon, action, targets):
+    names, unknown = resolve_targets(targets)
+    for target in unknown:
+        daemon.send(target + ': No such program name ! type "status"')
+    if not targets:
+        daemon.send(action + ': <program name>... | <name>:* | all')
+    if not names:
+        return
+    def report(results):
+        for name, result in results:
+            daemon.send(name + ': ' + result)
+        daemon.finish()
+    daemon.defer()
+    control(names, action, report)
+
+def rolling_restart_request(daemon, targets):
+    batch = 1
+    if targets[:1] == ['-b']:
+        try:
+            batch = int(targets[1])
+        except (IndexError, ValueError):
+            batch = 0
+        targets = targets[2:]
+    if batch < 1 or not targets:
+        daemon.send('rolling-restart: [-b <count>] <program name>... | <name>:* | all')
+        return
+    names, unknown = resolve_targets(targets)
+    for target in unknown:
+        daemon.send(target + ': No such program name ! type "status"')
+    if not names:
+        return
+    def report(results):
+        for name, result in results:
+            daemon.send(name + ': ' + result)
+        daemon.finish()
+    daemon.defer()
+    rolling_restart(names, batch, report)
+
+def tail_request(daemon, request):
+    follow = len(request) == 3 and request[1] == '-f'
+    name = request[-1]
+    if len(request) != (3 if follow else 2):
+        daemon.send('tail: [-f] <program name>')
+    elif name not in processes:
+        daemon.send('No such program name ! type "status"')
+    elif not processes[name].spec.capture:
+        daemon.send('Program output is not captured ! set capture=true')
+    else:
+        proc = processes[name]
+        if not proc.tail:
+            proc.tail = TailBuffer()
+        if follow:
+            daemon.send('Following ' + name + ', new output follows')   # tells the client it may start following
+        daemon.send(proc.tail.get().decode(errors='replace'))
+        if follow:
+            tail_follow(daemon.connection, proc.tail)
+
+def tail_follow(connection, tail):
+    dropped = [0]
+    def follower(data):
+        if connection.pending > HIGH_WATER:   # slow reader: drop output instead of queueing it
+            dropped[0] += len(data)
+            return
+        if dropped[0]:
+            connection.send('[... ' + str(dropped[0]) + ' bytes dropped ...]\n')
+            dropped[0] = 0
+        connection.send(data.decode(errors='replace'))
+    stop_following(connection)
+    tail.follow(follower)
+    followers[connection] = (tail, follower)
+    if stop_following not in connection.close_callbacks:
+        connection.on_close(stop_following)
+
+def stop_following(connection):
+    tail, follower = followers.pop(connection, (None, None))
+    if tail:
+        tail.unfollow(follower)
+
+def untail_request(daemon):
+    stop_following(daemon.connection)
+    if not daemon.connection.sentinel:
+        daemon.send(END)   # ends the stream the same way in both framing modes
+
+def subscribe_request(daemon, targets):
+    names, unknown = resolve_targets(targets)
+    if unknown:
+        daemon.send('\n'.join(target + ': No such program name ! type "status"' for target in unknown))
+        return
+    daemon.send('Subscribed to ' + (str(len(names)) if targets else 'all') + ' programs, state changes follow')
+    subscribe(daemon.connection, targets)
 
-def start_request(daemon, name):
-    if processes[name].state != 'RUNNING':
-        daemon.send('Starting program...')
-        processes[name].start()
-        daemon.send('Program started !')
+def unsubscribe_request(daemon):
+    unsubscribe(daemon.connection)
+    if not daemon.connection.sentinel:
+        daemon.send(END)   # ends the stream the same way in both framing modes
+
+def start_program(proc):
+    if proc.state in running_states or proc.state == 'STOPPING':
+        return False
+    proc.start()
+    return True
+
+def stop_program(proc):
+    if proc.state not in running_states:
+        return False
+    proc.stop()
+    return True
+
+def restart_program(proc):
+    if proc.state in running_states:
+        proc.restart = True
+        proc.stop()
+    elif proc.state == 'STOPPING':
+        proc.restart = True
     else:
-        daemon.send('Program already Running !')
+        proc.start()
+    return True
+
+# Batched control: every target is signalled or forked at once, the
+# callback gets the per-target results once the last one has settled
+
+def resolve_targets(targets):
+    names, unknown = dict(), list()
+    for target in targets:
+        if target == 'all':
+            matched = list(processes)
+        elif target.endswith(':*'):
+            matched = [proc.name for proc in processes.values() if proc.title == target[:-2]]
+        elif target in processes:
+            matched = [target]
+        else:
+            matched = []
+        if not matched:
+            unknown.append(target)
+        names.update(dict.fromkeys(matched))
+    return list(names), unknown
 
-def stop_request(daemon, name):
-    if processes[name].state == 'RUNNING':
-        daemon.send('Stopping program gracefully...(or killing it !)')
-        processes[name].stop()
-        daemon.send('Program stopped !')
+def control(names, action, callback):
+    results = dict.fromkeys(names)
+    pending = [len(names)]
+    def done(proc, result):
+        results[proc.name] = result
+        pending[0] -= 1
+        if not pending[0]:
+            callback(list(results.items()))
+    for name in names:
+        control_actions[action](processes[name], done)
+
+# Rolling restart: <batch> instances at a time, the next batch once these are
+# RUNNING again (ready, with a healthcheck); a failed batch stops the roll
+
+def rolling_restart(names, batch, callback):
+    results = list()
+    queue = list(names)
+    def next_batch():
+        wave = [name for name in queue[:batch] if name in processes]   # a reload may have removed some
+        del queue[:batch]
+        if wave:
+            control(wave, 'restart', settled)
+        elif queue:
+            next_batch()
+        else:
+            callback(results)
+    def settled(wave_results):
+        results.extend(wave_results)
+        if any(result != 'restarted' for name, result in wave_results):
+            results.extend((name, 'not restarted, rolling restart aborted') for name in queue)
+            callback(results)
+        else:
+            next_batch()
+    next_batch()
+
+def start_action(proc, done):
+    if not start_program(proc):
+        done(proc, 'already running')
     else:
-        daemon.send('Program not running !')
+        await_result(proc, start_result, done)
+
+def stop_action(proc, done):
+    if not stop_program(proc):
+        done(proc, 'not running')
+    else:
+        await_result(proc, stop_result, done)
+
+def restart_action(proc, done):
+    restart_program(proc)
+    await_result(proc, restart_result, done)
+
+def start_result(proc):
+    if proc.state == 'RUNNING':
+        return 'started'
+    elif proc.state == 'FATAL':
+        return 'ERROR (spawn error)'
+    elif proc.state not in running_states:
+        return 'ERROR (' + proc.description + ')'
+
+def stop_result(proc):
+    if proc.state == 'STOPPED':
+        return 'stopped'
+
+def restart_result(proc):
+    if proc.state == 'RUNNING':
+        return 'restarted'
+    elif proc.state == 'FATAL':
+        return 'ERROR (spawn error)'
+    elif proc.state == 'STOPPED' and not proc.restart:
+        return 'stopped'
+
+control_actions = {
+        'start': start_action,
+        'stop': stop_action,
+        'restart': restart_action
+        }
+
+def await_result(proc, result, done):
+    def waiter(proc):
+        outcome = result(proc)
+        if outcome:
+            done(proc, outcome)
+        return bool(outcome)
+    if not waiter(proc):
+        if proc.waiters is None:
+            proc.waiters = list()
+        proc.waiters.append(waiter)
 
-def restart_request(daemon, name):
-    daemon.send('Restarting program...')
-    if processes[name].state == 'RUNNING':
-        processes[name].stop()
-    processes[name].start()
-    daemon.send('Program started !')
+def notify_waiters(proc):
+    if proc.waiters:
+        proc.waiters = [waiter for waiter in proc.waiters if not waiter(proc)] or None
+
+# Machine protocol: JSON-lines requests {"id", "method", "params"} with typed results
+
+def rpc_handler(reply, request):
+    begin = time.perf_counter()
+    method = request.get('method')
+    params = request.get('params') or {}
+    if method == 'hello':
+        reply.result({'daemon': 'taskmasterd', 'pid': os.getpid(), 'methods': sorted(rpc_methods)})
+    elif method not in rpc_methods:
+        reply.error('unknown method: ' + str(method))
+        method = 'unknown'
+    else:
+        rpc_methods[method](reply, params)
+    request_seconds.observe(time.perf_counter() - begin, 'rpc', method)
+
+def rpc_status(reply, params):
+    names = params.get('names') or list(processes.keys())
+    unknown = [name for name in names if name not in processes]
+    if unknown:
+        reply.error('no such program: ' + ', '.join(unknown))
+        return
+    now = time.time()
+    fields = params.get('fields')
+    if not fields:
+        reply.result({'columns': status_fields[:STATUS_DEFAULT],
+                'rows': [status_row(processes[name], now)[:STATUS_DEFAULT] for name in names]})
+        return
+    columns = [str(field) for field in fields]
+    unknown = [field for field in columns if field not in status_fields]
+    if unknown:
+        reply.error('no such field: ' + ', '.join(unknown))
+        return
+    index = [status_fields.index(field) for field in columns]
+    rows = [status_row(processes[name], now) for name in names]
+    reply.result({'columns': columns, 'rows': [[row[i] for i in index] for row in rows]})
+
+def rpc_control(action):
+    def rpc_action(reply, params):
+        targets = params.get('names') or [params.get('name')]
+        names, unknown = resolve_targets([str(target) for target in targets])
+        if unknown or not names:
+            reply.error('no such program: ' + ', '.join(unknown))
+            return
+        control(names, action, lambda results: reply.result([
+            {'name': name, 'result': result, 'state': processes[name].state if name in processes else None}
+            for name, result in results]))
+    return rpc_action
+
+def rpc_rolling_restart(reply, params):
+    targets = params.get('names') or [params.get('name')]
+    names, unknown = resolve_targets([str(target) for target in targets])
+    batch = params.get('batch', 1)
+    if unknown or not names:
+        reply.error('no such program: ' + ', '.join(unknown))
+        return
+    if not isinstance(batch, int) or batch < 1:
+        reply.error('batch must be a positive integer')
+        return
+    rolling_restart(names, batch, lambda results: reply.result([
+        {'name': name, 'result': result, 'state': processes[name].state if name in processes else None}
+        for name, result in results]))
+
+def rpc_reload(reply, params):
+    if not reload_request():
+        reply.error('invalid configuration file, the daemon is quitting')
+        return
+    reply.result({'programs': len(processes)})
+
+def rpc_pid(reply, params):
+    reply.result(os.getpid())
+
+def rpc_subscribe(reply, params):
+    targets = [str(target) for target in params.get('names') or []]
+    names, unknown = resolve_targets(targets)
+    if unknown:
+        reply.error('no such program: ' + ', '.join(unknown))
+        return
+    reply.result({'subscribed': names if targets else list(processes)})
+    subscribe(reply.connection, targets)
+
+def rpc_unsubscribe(reply, params):
+    reply.result({'unsubscribed': unsubscribe(reply.connection)})
+
+def rpc_metrics(reply, params):
+    reply.result(render())
+
+rpc_methods = {
+        'status': rpc_status,
+        'start': rpc_control('start'),
+        'stop': rpc_control('stop'),
+        'restart': rpc_control('restart'),
+        'reload': rpc_reload,
+        'pid': rpc_pid,
+        'rolling_restart': rpc_rolling_restart,
+        'subscribe': rpc_subscribe,
+        'unsubscribe': rpc_unsubscribe,
+        'metrics': rpc_metrics
+        }
+
+# RPC status is a table, one row per program in the order of its columns:
+# the first STATUS_DEFAULT fields unless the request lists the ones it wants
+
+status_fields = ('name', 'state', 'pid', 'uptime', 'exitcode', 'retries', 'cpu_percent', 'rss_bytes', 'fds',
+        'health_failures', 'group', 'description')
+
+STATUS_DEFAULT = 10
+
+def status_row(proc, now):
+    usage = proc.usage
+    return (
+            proc.name,
+            proc.state,
+            proc.pid or None,
+            int(now - proc.startime) if proc.state in ('STARTING', 'RUNNING', 'STOPPING') else None,
+            proc.exit,
+            proc.retries_counter,
+            usage.cpu if usage else None,
+            usage.rss if usage else None,
+            usage.fds if usage else None,
+            proc.failures if proc.spec.healthcheck else None,
+            proc.title,
+            proc.description
+            )
 
 def reload_request():
+    global sections
+    begin = time.perf_counter()
     tasklog('RELOAD', 'taskmasterd', '')
     configfile = config_checkr()
     if not configfile:
         kill_processes()
-        sys.exit()
-    objc = create_processes(configfile)
-    unchanged_run_procs = [proc.name for proc in processes.values() for obj in objc.values() if obj.title == proc.title and obj == proc and proc.state == 'RUNNING']
-    deleted_procs = [proc.name for proc in processes.values() if proc.name not in unchanged_run_procs] #changed programs should get deleted
-    for name in deleted_procs:
-        if processes[name].state == 'RUNNING':
-            processes[name].stop()
-        del processes[name]
-    for new in objc.values():
-        if new.name not in unchanged_run_procs:
-            processes[new.name] = copy.deepcopy(new)
-            if processes[new.name].autostart == 'true':
-                processes[new.name].start()
+        return False
+    loaded = load_sections(configfile)
+    configure_daemon(configfile)
+    groups = dict()
+    for proc in processes.values():
+        groups.setdefault(proc.title, []).append(proc)
+    reloaded = dict()
+    to_start = []
+    for title, spec in loaded.items():
+        numprocs = spec.numprocs
+        old = groups.pop(title, [])
+        if spec.autoscale and old:
+            numprocs = min(max(len(old), spec.numprocs_min), spec.numprocs_max)   # keep what the autoscaler chose
+            old.sort(key=lambda proc: instance_index(proc.name))
+        unchanged = title in sections and sections[title] == spec
+        for index in range(numprocs):
+            if unchanged and index < len(old):
+                proc = old[index]   # untouched, renamed if numprocs crossed 1
+                proc.name = instance_name(title, index, max(numprocs, spec.numprocs_max))
+                proc.spec = spec
+            else:
+                proc = create_process(title, index, numprocs, spec)
+                if index < len(old):
+                    replace_process(old[index], proc, to_start)
+                elif spec.autostart:
+                    to_start.append(proc)
+            reloaded[proc.name] = proc
+        for proc in old[numprocs:]:
+            remove_process(proc)
+    for old in groups.values():
+        for proc in old:
+            remove_process(proc)
+    processes.clear()
+    processes.update(reloaded)
+    sections = loaded
+    release_listeners()
+    compact_journal()   # instances may have been renamed or removed
+    StartScheduler(to_start).pump()
+    reload_seconds.observe(time.perf_counter() - begin)
+    return True
+
+# Listening sockets outlive the instances they are passed to, and are only
+# closed once no loaded program names their address any more
+
+def bind_listeners(address):
+    sock = listeners.get(address)
+    if sock is None:
+        sock = listeners[address] = bind_listener(address)
+    return sock
+
+def release_listeners():
+    wanted = set(address for spec in sections.values() for address in spec.listen)
+    for address in list(listeners):
+        if address not in wanted:
+            close_listener(address, listeners.pop(address))
+
+def replace_process(old, new, to_start):
+    new.tail = old.tail
+    old.restart = False
+    if old.state in running_states:
+        old.stop()
+    if old.state == 'STOPPING':
+        old.successor = new   # started once the old instance is gone
+    elif new.spec.autostart:
+        to_start.append(new)
+
+def remove_process(proc):
+    proc.restart = False
+    proc.successor = None
+    if proc.state in running_states:
+        proc.stop()
 
 def quit_request(daemon):
+    global quit_client
     daemon.send('Killing child processes...')
-    kill_processes()
-    tasklog('QUIT', 'taskmasterd', '')
-    daemon.send('DOne!')
-    daemon.close_socket()
-    sys.exit()
+    daemon.defer()
+    quit_client = daemon
+    kill_processes()   # the loop stops once every child is reaped
 
 
 # Daemon process
 
+def callback_error(callback, err):
+    tasklog('CALLBACK', getattr(callback, '__qualname__', repr(callback)), type(err).__name__ + ': ' + str(err))
+
 def daemon_proc():
+    global loop, probes
     child = os.fork()
     if child == 0:
         print('Daemon PID:', os.getpid())
+        start_logger()
         tasklog('DAEMON', 'taskmasterd', str(os.getpid()))
         os.setsid()
+        set_subreaper()
+        loop = EventLoop()
+        loop.error_handler = callback_error
         set_signals()
+        probes = ProbeScheduler(loop)
+        daemon = ServerSocket(loop, daemon_ear, rpc_handler)
+        metrics = None
+        if METRICS_PORT:
+            try:
+                metrics = MetricsServer(loop)
+            except OSError as err:
+                tasklog('METRICS', 'taskmasterd', str(METRICS_PORT) + ': ' + err.strerror)
+        adopt_processes()
         spawn_processes()
-        daemon = ServerSocket()
-        daemon_ear(daemon)
+        loop.call_later(sample_interval, sample_processes)
+        loop.run()
+        processes.clear()
+        tasklog('QUIT', 'taskmasterd', '')
+        if quit_client:
+            quit_client.send('DOne!')
+            quit_client.finish()
+            quit_client.connection.drain()
+        daemon.close_socket()
+        for address in list(listeners):
+            close_listener(address, listeners.pop(address))
+        journal.close()
+        if metrics:
+            metrics.close()
+        stop_logger()
+        sys.exit()
 
-def daemon_ear(daemon):
-    while True:
-        request = daemon.recv()
-        if request == None:
-            continue
-        request = list(request.split(' '))
-        request_handler(daemon, request)
+def daemon_ear(client, request):
+    begin = time.perf_counter()   # the synchronous part only, deferred replies settle later
+    request = list(request.split(' '))
+    request_handler(client, request)
+    command = request[0] if request[0] in text_commands else 'unknown'
+    request_seconds.observe(time.perf_counter() - begin, 'text', command)
 
 
 # Processes main commands START/KILL
 
 def spawn_processes():
-    for proc in processes.values():
-        if proc.autostart == 'true':
-            proc.start()
+    StartScheduler([proc for proc in processes.values() if proc.spec.autostart]).pump()
+
+
+# A program starts no later than anything that depends on it: its priority
+# is lowered to theirs (the graph is acyclic, config_checkr made sure)
+
+def start_priorities():
+    priority = dict((title, spec.priority) for title, spec in sections.items())
+    changed = True
+    while changed:
+        changed = False
+        for title, spec in sections.items():
+            for dep in spec.depends_on:
+                if dep in priority and priority[dep] > priority[title]:
+                    priority[dep] = priority[title]
+                    changed = True
+    return priority
+
+
+# Startup scheduler: programs start by priority (lower first) and after the
+# programs they depend on are RUNNING, with an optional bound on spawns in flight
+
+class StartScheduler():
+    def __init__(self, procs):
+        self.priority = start_priorities()
+        self.pending = sorted(procs, key=self.rank)
+        self.scheduled = set(proc.name for proc in procs)
+        self.settled = dict()   # name -> True once RUNNING, False if it failed to start
+        self.starting = dict()  # name -> process spawned, not RUNNING yet
+        self.waves = collections.Counter()      # priority -> instances starting
+        self.titles = collections.Counter()     # title -> instances starting
+        self.groups = dict()    # title -> instances
+        for proc in processes.values():
+            self.groups.setdefault(proc.title, []).append(proc)
+    def pump(self):
+        waiting = list()
+        for index, proc in enumerate(self.pending):
+            if start_concurrency and len(self.starting) >= start_concurrency:
+                waiting.extend(self.pending[index:])
+                break
+            failed = self.failed_dependency(proc)
+            if failed:
+                self.settled[proc.name] = False
+                proc.description = 'Not started: dependency ' + failed + ' is not running'
+            elif self.ready(proc, waiting):
+                self.starting[proc.name] = proc
+                self.waves[self.rank(proc)] += 1
+                self.titles[proc.title] += 1
+                if start_program(proc):
+                    await_result(proc, start_result, self.done)
+                else:
+                    self.done(proc, 'already running')
+            else:
+                waiting.append(proc)
+        self.pending = waiting
+    def rank(self, proc):
+        return self.priority.get(proc.title, proc.spec.priority)
+    def ready(self, proc, waiting):
+        priority = self.rank(proc)
+        if self.waves and min(self.waves) < priority:
+            return False
+        if waiting and self.rank(waiting[0]) < priority:
+            return False   # a lower priority wave is not settled yet
+        for title in proc.spec.depends_on:
+            for dep in self.groups.get(title, []):
+                if dep.name in self.scheduled and dep.name not in self.settled:
+                    return False
+        concurrency = proc.spec.start_concurrency
+        return not concurrency or self.titles[proc.title] < concurrency
+    def failed_dependency(self, proc):
+        for title in proc.spec.depends_on:
+            for dep in self.groups.get(title, []):
+                if dep.name in self.scheduled and dep.name not in self.settled:
+                    continue
+                if dep.state not in running_states:
+                    return dep.name
+        return None
+    def done(self, proc, result):
+        if self.starting.pop(proc.name, None):
+            priority = self.rank(proc)
+            self.waves[priority] -= 1
+            if not self.waves[priority]:
+                del self.waves[priority]
+            self.titles[proc.title] -= 1
+        self.settled[proc.name] = result in ('started', 'already running')
+        if self.pending:
+            loop.call_soon(self.pump)
 
 
 def kill_processes():
+    global quitting
+    quitting = True
     for proc in processes.values():
-        if proc.state == 'RUNNING':
+        proc.restart = False
+        if proc.state in running_states:
             proc.stop()
-    processes.clear()
+    if not pids:
+        loop.stop()
 
 
 # Configuration file source
 
-def create_processes(configfile):
+def configure_daemon(configfile):
+    global sample_interval, start_concurrency
+    sample_interval = configfile.getfloat('taskmasterd', 'sample_interval', fallback=SAMPLE_INTERVAL)
+    start_concurrency = configfile.getint('taskmasterd', 'start_concurrency', fallback=START_CONCURRENCY)
+
+
+def program_sections(configfile):
+    return [section for section in configfile.sections() if section != 'taskmasterd']
+
+
+def load_sections(configfile):
+    loaded = dict()
+    for section in program_sections(configfile):
+        title = section.split(':')[1]
+        options = dict(configfile.items(section))
+        if title in sections and sections[title].options == tuple(sorted(options.items())):
+            loaded[title] = sections[title]   # unchanged, keep sharing the compiled one
+        else:
+            loaded[title] = ProgramSpec(title, options)
+    return loaded
+
+
+def create_processes(loaded):
     proc_obj = dict()
-    sections = configfile.sections()
-    for section in sections:
-        proc_name = section.split(':')[1]
-        try:
-            num_procs = int(configfile.get(section, 'numprocs'))
-        except:
-            num_procs = 1
-        for i in range(num_procs):
-            name = proc_name
-            if num_procs > 1:
-                name += ':' + str(i)
-            proc_obj[name] = Process(name) 
-            proc_obj[name].title = proc_name
-            for option in configfile.options(section):
-                setattr(proc_obj[name], option, configfile.get(section, option))
-    return (copy.deepcopy(proc_obj))
+    for title, spec in loaded.items():
+        for i in range(spec.numprocs):
+            proc = create_process(title, i, spec.numprocs, spec)
+            proc_obj[proc.name] = proc
+    return (proc_obj)
+
+
+def create_process(title, index, num_procs, spec):
+    # autoscaled pools keep the 'name:index' form even while down to one instance
+    return Process(instance_name(title, index, max(num_procs, spec.numprocs_max)), spec)
+
+
+def instance_name(title, index, num_procs):
+    if num_procs > 1:
+        return title + ':' + str(index)
+    return title
+
+
+def instance_index(name):
+    title, _, index = name.rpartition(':')
+    return int(index) if title else 0
+
+
 
 
 def option_value(config, section, option):
-    if option in ['numprocs', 'startsecs', 'startretries', 'stopwaitsecs', 'umask']:
+    if option in ['numprocs_min', 'numprocs_max']:
+        try:
+            low = config.getint(section, 'numprocs_min', fallback=1)
+            high = config.getint(section, 'numprocs_max', fallback=low)
+        except ValueError:
+            return (0)
+        if low < 1 or high < low:
+            return (0)
+    elif option in ['scale_up', 'scale_down', 'scale_cooldown']:
+        try:
+            value = config.getfloat(section, option)
+            up = config.getfloat(section, 'scale_up', fallback=float(spec_defaults['scale_up']))
+            down = config.getfloat(section, 'scale_down', fallback=float(spec_defaults['scale_down']))
+        except ValueError:
+            return (0)
+        if value < 0 or down >= up:
+            return (0)
+    elif option == 'scale_metric':
+        kind, _, path = config.get(section, option).partition(':')
+        if not (kind == 'cpu' and not path) and not (kind == 'file' and path):
+            return (0)
+    elif option in ['numprocs', 'startsecs', 'startretries', 'stopwaitsecs',
+            'stdout_maxbytes', 'stdout_backups', 'stderr_maxbytes', 'stderr_backups',
+            'priority']:
         try:
             config.getint(section, option)
         except:
             return (0)
+    elif option == 'start_concurrency':
+        try:
+            if config.getint(section, option) < 0:
+                return (0)
+        except ValueError:
+            return (0)
+    elif option in ['backoff_base', 'backoff_max', 'backoff_jitter']:
+        try:
+            value = config.getfloat(section, option)
+        except ValueError:
+            return (0)
+        if value < 0 or (option == 'backoff_jitter' and value > 1):
+            return (0)
+    elif option in ['healthcheck_interval', 'healthcheck_timeout', 'sample_interval']:
+        try:
+            if config.getfloat(section, option) <= 0:
+                return (0)
+        except ValueError:
+            return (0)
+    elif option in ['healthcheck_threshold', 'ready_timeout']:
+        try:
+            if config.getint(section, option) < 1:
+                return (0)
+        except ValueError:
+            return (0)
+    elif option == 'healthcheck':
+        try:
+            parse_healthcheck(config.get(section, option))
+        except ValueError:
+            return (0)
+    elif option == 'listen':
+        try:
+            parse_listen(config.get(section, option))
+        except ValueError:
+            return (0)
+    elif option in limit_parsers:
+        try:
+            limit_parsers[option](config.get(section, option))
+        except ValueError:
+            return (0)
+    elif option in cgroup_options and not config.get(section, 'cgroup', fallback=''):
+        return (0)
+    elif option == 'umask':
+        try:
+            int(config.get(section, option), 8)
+        except ValueError:
+            return (0)
+    elif option == 'environment':
+        for var in config.get(section, option).split(','):
+            name, colon, value = var.partition(':')
+            if var and not (name and colon):
+                return (0)
+    elif option == 'exitcodes':
+        try:
+            [int(code) for code in config.get(section, option).split(',') if code.strip()]
+        except ValueError:
+            return (0)
+    elif option == 'command':
+        try:
+            if not shlex.split(config.get(section, option)):
+                return (0)
+        except ValueError:
+            return (0)
     elif option == 'stopsignal' and config.get(section, option) not in stop_signals.keys():
         return (0)    
     elif option in ['autorestart', 'autostart'] and config.get(section, option) not in ['true', 'false', 'unexpected']:
         return (0)
+    elif option in ['capture', 'cpu_pin'] and config.get(section, option) not in ['true', 'false']:
+        return (0)
     return (1) 
 
 
@@ -367,24 +1776,60 @@ def config_checkr():
         tasklog('CONFIG', 'config', '')
         return (0)
     pattern = re.compile('program:')
-    sections = configfile.sections() 
-    for section in sections:
+    for section in configfile.sections():
+        if section == 'taskmasterd':
+            for option in configfile.options(section):
+                if option not in daemon_options or not option_value(configfile, section, option):
+                    tasklog('OPTION', 'config', '')
+                    return (0)
+            continue
         if not pattern.match(section):
             tasklog('SECTION', 'config', '')
             return (0) 
+        loaded = sections.get(section.split(':')[1])
+        if loaded and loaded.options == tuple(sorted(configfile.items(section))):
+            continue   # already checked when it was loaded
         options = configfile.options(section)
         for option in options:            
             if option not in options_sample or not option_value(configfile, section, option):
                 tasklog('OPTION', 'config', '')
                 return (0)
+        if 'command' not in options:
+            tasklog('OPTION', 'config', '')
+            return (0)
+    if not dependencies_checkr(configfile):
+        tasklog('DEPENDS', 'config', '')
+        return (0)
     return (configfile)
 
 
+def dependencies_checkr(configfile):
+    graph = dict()
+    for section in program_sections(configfile):
+        depends_on = configfile.get(section, 'depends_on', fallback='')
+        graph[section.split(':')[1]] = [title.strip() for title in depends_on.split(',') if title.strip()]
+    visiting, done = set(), set()
+    def visit(title):
+        if title in done:
+            return True
+        if title in visiting or title not in graph:
+            return False
+        visiting.add(title)
+        if not all(visit(dep) for dep in graph[title]):
+            return False
+        visiting.discard(title)
+        done.add(title)
+        return True
+    return all(visit(title) for title in graph)
+
+
 def main():
-    global processes
+    global processes, sections
     configfile = config_checkr()
     if  configfile:
-        processes = create_processes(configfile)
+        configure_daemon(configfile)
+        sections = load_sections(configfile)
+        processes = create_processes(sections)
         daemon_proc()
 
 if __name__ == "__main__":
@@ -0,0 +1,190 @@
+import bisect
+import errno
+import socket
+
+from tasklog import tasklog
+
+METRICS_HOST = '127.0.0.1'
+
+METRICS_PORT = 9717     # Prometheus text on http://METRICS_HOST:METRICS_PORT/metrics, 0 disables it
+
+MAX_REQUEST = 8192
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+registry = list()
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def label_text(names, values, extra=''):
+    pairs = [name + '="' + escape(value) + '"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Counter():
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = dict()
+        if not labels:
+            self.values[()] = 0
+        registry.append(self)
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+    def render(self, lines):
+        lines.append('# HELP ' + self.name + ' ' + self.help)
+        lines.append('# TYPE ' + self.name + ' counter')
+        for labels, value in sorted(self.values.items()):
+            lines.append(self.name + label_text(self.labels, labels) + ' ' + number(value))
+
+
+class Gauge():
+    def __init__(self, name, help, collect, labels=()):
+        self.name = name
+        self.help = help
+        self.collect = collect      # called at scrape time, yields (label values, value)
+        self.labels = labels
+        registry.append(self)
+    def render(self, lines):
+        lines.append('# HELP ' + self.name + ' ' + self.help)
+        lines.append('# TYPE ' + self.name + ' gauge')
+        for labels, value in self.collect():
+            lines.append(self.name + label_text(self.labels, labels) + ' ' + number(value))
+
+
+class Histogram():
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labels = labels
+        self.series = dict()   # label values -> [per bucket counts + overflow, sum, count]
+        registry.append(self)
+    def observe(self, value, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+    def render(self, lines):
+        lines.append('# HELP ' + self.name + ' ' + self.help)
+        lines.append('# TYPE ' + self.name + ' histogram')
+        for labels, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket
+                lines.append(self.name + '_bucket' + label_text(self.labels, labels, 'le="' + number(bound) + '"')
+                        + ' ' + str(cumulative))
+            lines.append(self.name + '_sum' + label_text(self.labels, labels) + ' ' + repr(total))
+            lines.append(self.name + '_count' + label_text(self.labels, labels) + ' ' + str(count))
+
+
+def render():
+    lines = list()
+    for metric in registry:
+        metric.render(lines)
+    return '\n'.join(lines) + '\n'
+
+
+# Minimal HTTP endpoint on the daemon's event loop: one response per connection
+
+class MetricsServer():
+    def __init__(self, loop, host=METRICS_HOST, port=METRICS_PORT):
+        self.loop = loop
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.socket.bind((host, port))
+            self.socket.listen(16)
+        except OSError:
+            self.socket.close()
+            raise
+        self.socket.setblocking(False)
+        self.requests = dict()    # client socket -> bytes received so far
+        self.responses = dict()   # client socket -> memoryview left to send
+        self.loop.add_reader(self.socket, self.accept)
+    def accept(self):
+        while True:
+            try:
+                client, address = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as err:
+                # out of fds or memory, or a network error of a pending connection passed
+                # through by accept(): either way try again on the next readiness event
+                if err.errno not in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    tasklog('ACCEPT', 'metrics', err.strerror or str(err))
+                return
+            client.setblocking(False)
+            self.requests[client] = b''
+            self.loop.add_reader(client, self.read, client)
+    def read(self, client):
+        try:
+            data = client.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.drop(client)
+            return
+        request = self.requests[client] + data
+        if b'\r\n\r\n' not in request and b'\n\n' not in request:
+            if len(request) > MAX_REQUEST:
+                self.drop(client)
+            else:
+                self.requests[client] = request
+            return
+        line = request.split(b'\n', 1)[0].split()
+        if len(line) >= 2 and line[0] in (b'GET', b'HEAD') and line[1].split(b'?')[0] in (b'/', b'/metrics'):
+            status, body = '200 OK', render().encode()
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        header = ('HTTP/1.0 ' + status + '\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                + 'Content-Length: ' + str(len(body)) + '\r\nConnection: close\r\n\r\n').encode()
+        self.loop.remove_reader(client)
+        del self.requests[client]
+        self.responses[client] = memoryview(header + (b'' if line[:1] == [b'HEAD'] else body))
+        self.write(client)
+    def write(self, client):
+        response = self.responses[client]
+        try:
+            sent = client.send(response)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.drop(client)
+            return
+        response = self.responses[client] = response[sent:]
+        if response.nbytes:
+            self.loop.add_writer(client, self.write, client)
+        else:
+            self.drop(client)
+    def drop(self, client):
+        self.loop.remove_reader(client)
+        self.loop.remove_writer(client)
+        self.requests.pop(client, None)
+        self.responses.pop(client, None)
+        client.close()
+    def close(self):
+        for client in list(self.requests) + list(self.responses):
+            self.drop(client)
+        self.loop.remove_reader(self.socket)
+        self.socket.close()
@@ -9,6 +9,11 @@ import socket
 import struct
 import sys
 import errno
+import collections
+import itertools
+import json
+
+from tasklog import tasklog
 
 END = 'DAEMON COPY'
 
@@ -17,57 +22,311 @@ SOCKFILE = '/tmp/taskmaster.sock'
 LOGFILE = 'tmp/taskmaster.log'
 
 
+PROTOCOL = 'protocol 2'    # one frame per reply, no END sentinel
+
+RPC_VERSION = 1             # JSON-lines requests, detected by a leading '{'
+
+RECV_SIZE = 65536
+
+MAX_FRAME = 1024 * 1024         # largest request a client may send
+
+HIGH_WATER = 256 * 1024         # stop reading requests from a client above this much unsent output
+
+MAX_PENDING = 8 * 1024 * 1024   # drop a client that stopped reading altogether
+
+IOV_MAX = 512
+
+HEADER = struct.Struct('!I')
+
+encoder = json.JSONEncoder(separators=(',', ':'), check_circular=False)   # responses are built fresh, never cyclic
+
+
+def frame(data):
+    return (HEADER.pack(len(data)), data)
+
+
 class ServerSocket():
-    def __init__(self):
+    def __init__(self, loop, handler, rpc_handler=None):
         self.sock_address = SOCKFILE
         try:
             os.remove(self.sock_address)
         except OSError:
             pass
         self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        self.connection = None
-        self.address = None
         self.socket.bind(self.sock_address)
-        self.socket.listen(1)
-        self.accept()
+        self.socket.listen(128)
+        self.socket.setblocking(False)
+        self.loop = loop
+        self.handler = handler
+        self.rpc_handler = rpc_handler
+        self.connections = set()
+        self.loop.add_reader(self.socket, self.accept)
     def accept(self):
-        try:
-            self.connection, self.address = self.socket.accept()
-        except socket.error as err:
-            if err.errno == errno.EINTR:
-                self.accept()
-    def send(self, msg):
-        try:
-            length = struct.pack('!I', len(msg))
-            self.connection.sendall(length)
-            self.connection.sendall(msg.encode())
-        except socket.error as err:
-            if err.errno == errno.EBADF:
-                self.accept()
-            if err.errno == errno.EINTR:
-                self.send(msg)
-    def recv(self):
-        try:
-            n = self.connection.recv(4)
-            if not n: return None
-            length, = struct.unpack('!I', n)
-            message = self.connection.recv(length)
-            return message.decode()
-        except socket.error as err:
-            if err.errno == errno.EBADF:
-                self.accept()
-            if err.errno == errno.EINTR:
-                pass
-    def close_connection(self):
-        if self.connection:
-            self.connection.close()
+        while True:
+            try:
+                connection, address = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as err:
+                # out of fds or memory, or a network error of a pending connection passed
+                # through by accept(): either way try again on the next readiness event
+                if err.errno not in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    tasklog('ACCEPT', 'socket', err.strerror or str(err))
+                return
+            self.connections.add(Connection(self, connection))
     def close_socket(self):
+        for connection in list(self.connections):
+            connection.close()
         if self.socket:
+            self.loop.remove_reader(self.socket)
             self.socket.close()
+            self.socket = None
+
+
+class Reply():
+    def __init__(self, connection):
+        self.connection = connection
+        self.lines = []
+        self.deferred = False
+        self.done = False
+    def send(self, msg):
+        self.lines.append(msg)
+    def defer(self):
+        self.deferred = True
+    def finish(self):
+        self.done = True
+        self.connection.flush_replies()
+    def close(self):
+        self.connection.close()
+    def encode(self):
+        return '\n'.join(self.lines).encode()
+
+
+class RpcReply(Reply):
+    def __init__(self, connection, request_id):
+        Reply.__init__(self, connection)
+        self.response = {'v': RPC_VERSION, 'id': request_id}
+    def result(self, value):
+        self.response['ok'] = True
+        self.response['result'] = value
+        self.finish()
+    def error(self, msg):
+        self.response['ok'] = False
+        self.response['error'] = msg
+        self.finish()
+    def finish(self):
+        # sent as soon as it is done: the id tells the client which request it answers
+        self.done = True
+        self.connection.write_raw(self.encode(), self.connection.dispatching)
+    def encode(self):
+        return encoder.encode(self.response).encode() + b'\n'
+
+
+class Connection():
+    def __init__(self, server, sock):
+        self.server = server
+        self.loop = server.loop
+        self.socket = sock
+        self.socket.setblocking(False)
+        self.rbuf = bytearray(RECV_SIZE)
+        self.rview = memoryview(self.rbuf)
+        self.rstart = 0
+        self.rend = 0
+        self.wqueue = collections.deque()
+        self.pending = 0
+        self.replies = collections.deque()
+        self.sentinel = True    # compatibility mode: replies end with an END frame
+        self.rpc = None         # decided by the first byte the client sends
+        self.dispatching = False    # reading pipelined RPC requests, their replies go out in one write
+        self.paused = False
+        self.closed = False
+        self.close_callbacks = list()
+        self.loop.add_reader(self.socket, self._read)
+    def _read(self):
+        if self.closed:
+            return
+        if self.rend == len(self.rbuf):
+            self._make_room(RECV_SIZE)
+        try:
+            n = self.socket.recv_into(self.rview[self.rend:])
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            n = 0
+        if not n:
+            self.close()
+            return
+        self.rend += n
+        self._dispatch()
+    def _make_room(self, needed):
+        available = self.rend - self.rstart
+        if self.rstart:
+            self.rbuf[:available] = self.rbuf[self.rstart:self.rend]
+            self.rstart, self.rend = 0, available
+        if len(self.rbuf) - self.rend < needed:
+            self.rview.release()
+            self.rbuf.extend(bytes(needed - (len(self.rbuf) - self.rend)))
+            self.rview = memoryview(self.rbuf)
+    def _dispatch(self):
+        if self.rpc is None and self.rend > self.rstart:
+            self.rpc = self.rbuf[self.rstart] == ord('{') and self.server.rpc_handler is not None
+        if self.rpc:
+            self._dispatch_lines()
+            return
+        while not self.closed and not self.paused and self.rend - self.rstart >= HEADER.size:
+            length, = HEADER.unpack_from(self.rbuf, self.rstart)
+            if length > MAX_FRAME:
+                self.close()
+                return
+            end = self.rstart + HEADER.size + length
+            if end > self.rend:
+                if end > len(self.rbuf):
+                    self._make_room(HEADER.size + length - (self.rend - self.rstart))
+                break
+            message = str(self.rview[self.rstart + HEADER.size:end], 'utf-8', 'replace')
+            self.rstart = end
+            self._request(message)
+        if self.rstart == self.rend:
+            self.rstart = self.rend = 0
+    def _dispatch_lines(self):
+        self.dispatching = True
+        while not self.closed and not self.paused:
+            end = self.rbuf.find(b'\n', self.rstart, self.rend)
+            if end < 0:
+                if self.rend - self.rstart > MAX_FRAME:
+                    self.close()
+                elif self.rend == len(self.rbuf):
+                    self._make_room(RECV_SIZE)
+                break
+            line = self.rview[self.rstart:end]
+            self.rstart = end + 1
+            if line.nbytes and not bytes(line).isspace():
+                self._rpc_request(line)
+        self.dispatching = False
+        if self.wqueue:
+            self._write()
+        if self.rstart == self.rend:
+            self.rstart = self.rend = 0
+    def _rpc_request(self, line):
+        try:
+            request = json.loads(str(line, 'utf-8'))
+            request_id = request.get('id')
+        except (ValueError, AttributeError):
+            request, request_id = None, None
+        reply = RpcReply(self, request_id)
+        if request is None:
+            reply.error('malformed request')
+            return
+        try:
+            self.server.rpc_handler(reply, request)
+        except Exception as err:
+            if not reply.done:
+                reply.error('internal error: ' + str(err))
+    def _request(self, message):
+        if message == PROTOCOL:
+            self.sentinel = False
+            self.write(message.encode())
+            return
+        reply = Reply(self)
+        self.replies.append(reply)
+        try:
+            self.server.handler(reply, message)
+        except Exception as err:
+            if not reply.done:
+                reply.send('internal error: ' + str(err))
+                reply.finish()
+            return
+        if not reply.deferred:
+            reply.finish()
+    def flush_replies(self):
+        while self.replies and self.replies[0].done:
+            reply = self.replies.popleft()
+            if reply.lines or not self.sentinel:
+                self.write(reply.encode(), self.sentinel)
+            if self.sentinel:
+                self.write(END.encode())
+    def send(self, msg):
+        self.write(msg.encode())
+    def write(self, data, more=False):
+        if self.closed:
+            return
+        header, data = frame(data)
+        self.wqueue.append(header)
+        if data:    # a zero-length buffer would never be popped by _write
+            self.wqueue.append(data)
+        self.pending += HEADER.size + len(data)
+        if not more:
+            self._write()
+    def write_raw(self, data, more=False):
+        if self.closed:
+            return
+        if data:
+            self.wqueue.append(data)
+            self.pending += len(data)
+        if not more:
+            self._write()
+    def _write(self):
+        if self.closed:
+            return
+        while self.wqueue:
+            buffers = list(itertools.islice(self.wqueue, IOV_MAX))
+            try:
+                sent = self.socket.sendmsg(buffers)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                self.close()
+                return
+            self.pending -= sent
+            while sent:
+                head = self.wqueue[0]
+                if len(head) <= sent:
+                    sent -= len(head)
+                    self.wqueue.popleft()
+                else:
+                    self.wqueue[0] = memoryview(head)[sent:]
+                    sent = 0
+        if self.pending > MAX_PENDING:
+            self.close()
+        elif self.wqueue:
+            self.loop.add_writer(self.socket, self._write)
+            if self.pending > HIGH_WATER and not self.paused:
+                self.paused = True
+                self.loop.remove_reader(self.socket)
+        else:
+            self.loop.remove_writer(self.socket)
+            if self.paused:
+                self.paused = False
+                self.loop.add_reader(self.socket, self._read)
+                self._dispatch()
+    def drain(self):
+        if self.closed:
+            return
+        try:
+            self.socket.setblocking(True)
+            for data in self.wqueue:
+                self.socket.sendall(data)
+            self.wqueue.clear()
+        except OSError:
+            pass
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.remove_reader(self.socket)
+        self.loop.remove_writer(self.socket)
+        self.socket.close()
+        self.server.connections.discard(self)
+        for callback in self.close_callbacks:
+            callback(self)
+    def on_close(self, callback):
+        self.close_callbacks.append(callback)
+
 
 class ClientSocket():
     def __init__(self):
         self.sock_address = SOCKFILE
+        self.batched = False
         self.connect()
     def connect(self):
         try:
@@ -77,25 +336,48 @@ class ClientSocket():
             if  err.errno == errno.ECONNREFUSED:
                 print('No Daemon , Try Starting It !')
                 sys.exit()
+    def negotiate(self):
+        self.send(PROTOCOL)
+        self.batched = self.recv() == PROTOCOL
     def send(self, msg):
         try:
-            length = struct.pack('!I', len(msg))
-            self.socket.sendall(length)
-            self.socket.sendall(msg.encode())
+            data = msg.encode()
+            self.socket.sendall(HEADER.pack(len(data)) + data)
         except (OSError, socket.error) as err:
             if  err.errno == errno.EPIPE or err.errno == errno.ENOTCONN:
                 print('No Daemon , Try Starting It !')
                 sys.exit()
+    def _recv_exact(self, length):
+        data = bytearray(length)
+        view = memoryview(data)
+        received = 0
+        while received < length:
+            n = self.socket.recv_into(view[received:])
+            if not n:
+                return None
+            received += n
+        return data
     def recv(self):
         try:
-            n = self.socket.recv(4)
+            n = self._recv_exact(HEADER.size)
             if not n: return None
-            length, = struct.unpack('!I', n)
-            message = self.socket.recv(length)
-            return message.decode()
+            length, = HEADER.unpack(n)
+            message = self._recv_exact(length)
+            if message is None: return None
+            return message.decode(errors='replace')
         except (OSError, socket.error) as err:
             if  err.errno == errno.EPIPE or err.errno == errno.ENOTCONN:
                 print('No Daemon , Try Starting It !')
                 sys.exit()
+    def reply(self):
+        if self.batched:
+            return self.recv()
+        lines = []
+        while True:
+            data = self.recv()
+            if data is None or data == END:
+                break
+            lines.append(data)
+        return '\n'.join(lines)
     def close(self):
         self.socket.close()
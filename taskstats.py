@@ -0,0 +1,54 @@
+import os
+
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+class Usage():
+    __slots__ = ('pid', 'when', 'ticks', 'cpu', 'rss', 'fds')
+    def __init__(self, pid, when, ticks, cpu, rss, fds):
+        self.pid = pid
+        self.when = when
+        self.ticks = ticks
+        self.cpu = cpu      # percent of one CPU since the previous sample
+        self.rss = rss      # bytes
+        self.fds = fds      # None when /proc/<pid>/fd is not readable
+
+
+def read_usage(pid, when, previous=None):
+    try:
+        with open('/proc/' + str(pid) + '/stat', 'rb') as stat:
+            data = stat.read()
+        with open('/proc/' + str(pid) + '/statm', 'rb') as statm:
+            resident = int(statm.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    # comm may contain spaces and parentheses, the fixed fields start after the last ')'
+    fields = data[data.rfind(b')') + 2:].split()
+    ticks = int(fields[11]) + int(fields[12])   # utime + stime
+    try:
+        fds = len(os.listdir('/proc/' + str(pid) + '/fd'))
+    except OSError:
+        fds = None
+    cpu = None      # needs two samples of the same pid
+    if previous is not None and previous.pid == pid and when > previous.when:
+        cpu = round((ticks - previous.ticks) / CLK_TCK / (when - previous.when) * 100, 1)
+    return Usage(pid, when, ticks, cpu, resident * PAGE_SIZE, fds)
+
+
+def read_start_ticks(pid):
+    # start time in clock ticks since boot: tells a live process from a recycled pid
+    try:
+        with open('/proc/' + str(pid) + '/stat', 'rb') as stat:
+            data = stat.read()
+        return int(data[data.rfind(b')') + 2:].split()[19])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def format_bytes(size):
+    for unit in ('B', 'K', 'M', 'G'):
+        if size < 1024 or unit == 'G':
+            return ('%d' % size if unit == 'B' else '%.1f' % size) + unit
+        size /= 1024